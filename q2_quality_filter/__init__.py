@@ -6,10 +6,14 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
-from ._filter import q_score
+from ._filter import (q_score, q_score_multi, q_score_stats,
+                      q_score_with_profile)
+from ._paired import q_score_paired
+from ._sweep import q_score_sweep
 from ._version import get_versions
 
 __version__ = get_versions()['version']
 del get_versions
 
-__all__ = ['q_score']
+__all__ = ['q_score', 'q_score_multi', 'q_score_paired', 'q_score_stats',
+           'q_score_sweep', 'q_score_with_profile']
@@ -0,0 +1,238 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from ._compression import _BACKEND, _place_file
+from ._index import _digest
+
+
+# parameters which do not affect the output of a sample
+_UNCACHED_PARAMS = {'truncation_index'}
+
+_READS = 'reads.fastq.gz'
+_STATS = 'stats.json'
+
+
+def _plugin_version():
+    # imported here as the package imports this module while initializing
+    import q2_quality_filter
+    return q2_quality_filter.__version__
+
+
+def _sample_key(input_path, phred_offset, params):
+    """Identify the output of a sample
+
+    The key is a digest of the contents of the input, the parameters
+    affecting the output, the plugin version and the compression backend.
+    """
+    description = json.dumps([
+        _digest(input_path), phred_offset,
+        sorted((name, value) for name, value in params.items()
+               if name not in _UNCACHED_PARAMS),
+        _plugin_version(), _BACKEND.name])
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+class _ResultCache:
+    """Filtered reads and stats of samples, stored in a directory
+
+    Each entry is a directory named by the _sample_key of a sample, holding
+    the stats of the sample and, if any reads were kept, its filtered reads.
+    The modification time of an entry records its last use, and the least
+    recently used entries are evicted once the cache exceeds max_size bytes.
+    """
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key, output_path):
+        """Place the cached reads at output_path and return the stats
+
+        Returns None if the key is not cached.
+        """
+        entry = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(entry, _STATS)) as fh:
+                counts = json.load(fh)
+        except FileNotFoundError:
+            return None
+
+        reads = os.path.join(entry, _READS)
+        if os.path.exists(reads):
+            _place_file(reads, output_path)
+        os.utime(entry)
+        return counts
+
+    def put(self, key, output_path, counts):
+        """Add the reads at output_path and the stats of a sample"""
+        entry = os.path.join(self.directory, key)
+        if os.path.exists(entry):
+            return
+
+        # entries are assembled aside and renamed into place so that a
+        # partial entry is never used
+        staging = tempfile.mkdtemp(dir=self.directory, prefix='.')
+        try:
+            if os.path.exists(output_path):
+                _place_file(output_path, os.path.join(staging, _READS))
+            with open(os.path.join(staging, _STATS), 'w') as fh:
+                json.dump(counts, fh)
+            os.rename(staging, entry)
+        except OSError:
+            # another run added the entry first
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def entries(self):
+        """Returns (key, size in bytes, last use) of each entry, oldest first
+        """
+        entries = []
+        for key in os.listdir(self.directory):
+            entry = os.path.join(self.directory, key)
+            if key.startswith('.') or not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, name))
+                       for name in os.listdir(entry))
+            entries.append((key, size, os.path.getmtime(entry)))
+        entries.sort(key=lambda entry: entry[2])
+        return entries
+
+    def prune(self, max_size=None):
+        """Evict the oldest entries until at most max_size bytes remain
+
+        max_size defaults to that of the cache. Returns the keys evicted.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return []
+
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        evicted = []
+        for key, size, _ in entries:
+            if total <= max_size:
+                break
+            shutil.rmtree(os.path.join(self.directory, key),
+                          ignore_errors=True)
+            total -= size
+            evicted.append(key)
+        return evicted
+
+    def finish(self):
+        """Called once a run completes"""
+        self.prune()
+
+
+class _Checkpoint:
+    """A journal of the samples completed by a run, stored in a directory
+
+    As each sample completes, its filtered reads are placed in the directory
+    and a line holding its _sample_key and stats is appended to the journal.
+    A run restarted after being interrupted takes the samples recorded in
+    the journal from it, so that only the remaining samples are filtered.
+    The files of the checkpoint are removed once the run completes, and so
+    is the directory if nothing else is in it.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.journal_path = os.path.join(directory, 'journal.jsonl')
+        os.makedirs(directory, exist_ok=True)
+
+        self._completed = {}
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the line being written when the run was stopped
+                        break
+                    self._completed[record['key']] = record['counts']
+        self._journal = open(self.journal_path, 'a')
+
+    def _reads_path(self, key):
+        return os.path.join(self.directory, key + '.fastq.gz')
+
+    def get(self, key, output_path):
+        """Place the recorded reads at output_path and return the stats
+
+        Returns None if the key is not recorded.
+        """
+        counts = self._completed.get(key)
+        if counts is None or counts['total-retained-reads'] == 0:
+            return counts
+        if not os.path.exists(self._reads_path(key)):
+            return None
+        _place_file(self._reads_path(key), output_path)
+        return counts
+
+    def put(self, key, output_path, counts):
+        """Record a completed sample, with its reads at output_path"""
+        if key in self._completed:
+            return
+        # the reads are in place before the sample is journaled
+        if os.path.exists(output_path):
+            _place_file(output_path, self._reads_path(key))
+        self._journal.write(json.dumps({'key': key, 'counts': counts}) +
+                            '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._completed[key] = counts
+
+    def finish(self):
+        """Called once a run completes"""
+        self._journal.close()
+        # the directory may hold files other than those of the checkpoint
+        for key in self._completed:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._reads_path(key))
+        os.remove(self.journal_path)
+        with contextlib.suppress(OSError):
+            os.rmdir(self.directory)
+
+
+def main(argv=None):
+    """Inspect or prune a q_score result cache"""
+    parser = argparse.ArgumentParser(
+        prog='q2-quality-filter-cache', description=main.__doc__)
+    commands = parser.add_subparsers(dest='command', required=True)
+    inspect = commands.add_parser(
+        'inspect', help='List the entries of the cache, oldest first.')
+    inspect.add_argument('directory')
+    prune = commands.add_parser(
+        'prune', help='Evict the least recently used entries.')
+    prune.add_argument('directory')
+    prune.add_argument('--max-size', type=int, required=True,
+                       help='The size in megabytes to reduce the cache to. '
+                            'With 0, every entry is evicted.')
+    args = parser.parse_args(argv)
+
+    # a mistyped directory is reported rather than created
+    if not os.path.isdir(args.directory):
+        parser.error('%s is not a directory' % args.directory)
+    cache = _ResultCache(args.directory)
+    if args.command == 'inspect':
+        entries = cache.entries()
+        for key, size, used in entries:
+            print('%s\t%d\t%s' % (key, size,
+                                  time.strftime('%Y-%m-%d %H:%M:%S',
+                                                time.localtime(used))))
+        print('%d entries, %d bytes' % (
+            len(entries), sum(size for _, size, _ in entries)))
+    else:
+        evicted = cache.prune(args.max_size * 1024 * 1024)
+        print('evicted %d entries' % len(evicted))
@@ -0,0 +1,277 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import collections
+import concurrent.futures
+import contextlib
+import gzip
+import os
+import shutil
+import struct
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # reflinks are not available on Windows
+    fcntl = None
+
+
+class _Backend:
+    """A gzip implementation used to read and write FASTQ files"""
+    def __init__(self, name, module, file_class, levels):
+        self.name = name
+        self._module = module
+        self._file_class = file_class
+        # maps a gzip compression level (1-9) to one of the backend
+        self._levels = levels
+
+    def open(self, path):
+        return self._module.open(path, 'rb')
+
+    def reader(self, fileobj):
+        return self._file_class(fileobj=fileobj, mode='rb')
+
+    def compress(self, data, level):
+        return self._module.compress(data, compresslevel=self._levels(level))
+
+
+def _isal_backend():
+    from isal import igzip
+    # ISA-L provides compression levels 0 (fastest) to 3 (smallest)
+    return _Backend('isal', igzip, igzip.IGzipFile,
+                    lambda level: min(level // 3, 3))
+
+
+def _gzip_backend():
+    return _Backend('gzip', gzip, gzip.GzipFile, lambda level: level)
+
+
+# in order of preference; python-isal is considerably faster than zlib but
+# is an optional dependency
+_backends = [_isal_backend, _gzip_backend]
+
+
+def _load_backend():
+    for backend in _backends:
+        try:
+            return backend()
+        except ImportError:
+            continue
+
+
+_BACKEND = _load_backend()
+
+
+# the fixed part of a gzip member header carrying a BGZF extra field
+_BGZF_HEADER = struct.Struct('<4BI2BH')
+_BGZF_SUBFIELD = struct.Struct('<2BHH')
+
+
+_BgzfChunk = collections.namedtuple(
+    '_BgzfChunk', ['path', 'offset', 'skip', 'size', 'first'])
+_BgzfChunk.__doc__ = """A range of the decompressed data of a BGZF file
+
+Decompression starts at the compressed offset of a block. When the chunk is
+not the first of the file, skip bytes are discarded and the next byte read
+is the last byte preceding the chunk; the size bytes which follow it are the
+data of the chunk.
+"""
+
+
+def _bgzf_blocks(path):
+    """Index the blocks of a BGZF file
+
+    Returns a list of (compressed offset, decompressed size) pairs, one per
+    block, or None if the file is not BGZF. Only the block headers and
+    trailers are read.
+    """
+    blocks = []
+    with open(path, 'rb') as fh:
+        offset = 0
+        while True:
+            header = fh.read(_BGZF_HEADER.size)
+            if not header:
+                return blocks
+            if len(header) < _BGZF_HEADER.size:
+                return None
+
+            id1, id2, method, flags, _, _, _, xlen = \
+                _BGZF_HEADER.unpack(header)
+            if (id1, id2, method) != (31, 139, 8) or not flags & 4:
+                return None
+
+            block_size = None
+            extra = fh.read(xlen)
+            position = 0
+            while position + _BGZF_SUBFIELD.size <= len(extra):
+                si1, si2, length, value = _BGZF_SUBFIELD.unpack_from(
+                    extra, position)
+                if (si1, si2, length) == (66, 67, 2):
+                    block_size = value + 1
+                    break
+                position += 4 + length
+            if block_size is None:
+                return None
+
+            fh.seek(offset + block_size - 4)
+            trailer = fh.read(4)
+            if len(trailer) < 4:
+                return None
+            blocks.append((offset, struct.unpack('<I', trailer)[0]))
+            offset += block_size
+
+
+def _bgzf_chunks(path, chunk_size):
+    """Split a BGZF file into chunks of about chunk_size decompressed bytes
+
+    Returns None if the file is not BGZF.
+    """
+    blocks = _bgzf_blocks(path)
+    if blocks is None:
+        return None
+
+    chunks = []
+    # the block and position within it of the last byte read so far
+    previous = None
+    start = 0
+    while start < len(blocks):
+        end = start
+        size = 0
+        while end < len(blocks) and (size < chunk_size or size == 0):
+            size += blocks[end][1]
+            end += 1
+
+        if size > 0:
+            if previous is None:
+                chunks.append(_BgzfChunk(path, blocks[start][0], 0, size,
+                                         True))
+            else:
+                offset, skip = previous
+                chunks.append(_BgzfChunk(path, offset, skip, size, False))
+
+        # chunks after the first start reading at the last non-empty block
+        # of the previous chunk so that the byte preceding them is known
+        for index in range(end - 1, start - 1, -1):
+            if blocks[index][1] > 0:
+                previous = (blocks[index][0], blocks[index][1] - 1)
+                break
+        start = end
+
+    return chunks
+
+
+@contextlib.contextmanager
+def _open_bgzf_chunk(chunk):
+    """Open a chunk for reading, positioned as described by _BgzfChunk"""
+    with open(chunk.path, 'rb') as fh:
+        fh.seek(chunk.offset)
+        with _BACKEND.reader(fh) as reader:
+            remaining = chunk.skip
+            while remaining > 0:
+                skipped = len(reader.read(min(remaining, 1 << 20)))
+                if skipped == 0:
+                    break
+                remaining -= skipped
+            yield reader
+
+
+# number of bytes compressed into each gzip member by _ParallelGzipWriter
+_MEMBER_SIZE = 1024 * 1024
+
+
+class _ParallelGzipWriter:
+    """Write a gzip file, compressing independent members on a thread pool
+
+    Written data is collected into blocks of member_size bytes, each of which
+    is compressed into its own gzip member. The concatenation of the members
+    is a valid multi-member gzip file. Both zlib and ISA-L release the GIL
+    while compressing, so the members are compressed concurrently.
+    """
+    def __init__(self, path, threads=1, level=9, member_size=_MEMBER_SIZE):
+        self._fh = open(path, 'wb')
+        self._level = level
+        self._member_size = member_size
+        self._threads = threads
+        self._executor = concurrent.futures.ThreadPoolExecutor(threads) \
+            if threads > 1 else None
+        self._pending = collections.deque()
+        self._buffer = []
+        self._buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self._member_size:
+            self._compress()
+
+    def writelines(self, pieces):
+        for piece in pieces:
+            self.write(piece)
+
+    def _compress(self):
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+
+        if self._executor is None:
+            self._fh.write(_BACKEND.compress(data, self._level))
+            return
+
+        self._pending.append(
+            self._executor.submit(_BACKEND.compress, data, self._level))
+        # write completed members in order, bounding the number in flight
+        while self._pending and (self._pending[0].done() or
+                                 len(self._pending) > 2 * self._threads):
+            self._fh.write(self._pending.popleft().result())
+
+    def close(self):
+        if self._fh.closed:
+            return
+        try:
+            if self._buffered:
+                self._compress()
+            while self._pending:
+                self._fh.write(self._pending.popleft().result())
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+            self._fh.close()
+
+
+# the FICLONE ioctl of Linux, which shares the extents of a file on
+# filesystems supporting reflinks (e.g. btrfs, XFS)
+_FICLONE = 0x40049409
+
+
+def _place_file(source, destination):
+    """Make destination a copy of source as cheaply as possible
+
+    A hard link is attempted first, followed by a reflink and finally a byte
+    copy.
+    """
+    try:
+        os.link(source, destination)
+        return
+    except OSError:
+        pass
+
+    if fcntl is not None:
+        try:
+            with open(source, 'rb') as src, open(destination, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+
+    shutil.copyfile(source, destination)
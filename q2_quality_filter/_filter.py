@@ -6,8 +6,16 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
-import itertools
-import gzip
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import io
+import os
+import shutil
+import statistics
+import tempfile
+import time
 import yaml
 import pandas as pd
 
@@ -16,17 +24,276 @@ from q2_types.per_sample_sequences import (
             SingleLanePerSampleSingleEndFastqDirFmt,
             FastqManifestFormat, YamlFormat, FastqGzFormat)
 
+from ._cache import _Checkpoint, _ResultCache, _sample_key
+from ._compression import (_BACKEND, _bgzf_chunks, _open_bgzf_chunk,
+                           _ParallelGzipWriter, _place_file)
+from ._index import _ReadMeasures, _TruncationIndex
+from ._pipeline import _ReadAhead, _StageTimes, _WriteBehind
+from ._format import QualityFilterProfileFmt
+from ._profile import _QualityProfile, _profile_counts, _write_profile
+
+# number of decompressed bytes requested from the input stream per batch
+_BLOCK_SIZE = 4 * 1024 * 1024
+
+# the characters removed by bytes.strip()
+_WHITESPACE = np.zeros(256, dtype=bool)
+_WHITESPACE[list(b' \t\n\r\x0b\x0c')] = True
+
+
+def _strip_bounds(data, starts, ends):
+    """Narrow [starts, ends) line bounds as bytes.strip() would, in place"""
+    while True:
+        nonempty = ends > starts
+        trailing = np.zeros_like(nonempty)
+        trailing[nonempty] = _WHITESPACE[data[ends[nonempty] - 1]]
+        if not trailing.any():
+            break
+        ends[trailing] -= 1
+
+    while True:
+        nonempty = ends > starts
+        leading = np.zeros_like(nonempty)
+        leading[nonempty] = _WHITESPACE[data[starts[nonempty]]]
+        if not leading.any():
+            break
+        starts[leading] += 1
+
+
+def _gather(data, starts, lengths):
+    """Gather ragged byte ranges into a zero padded (n, max_len) matrix
+
+    Rows are taken from a strided view holding a row of max_len bytes at
+    each offset of data, so that each range is copied whole rather than
+    indexed byte by byte. Reads commonly share their length, in which case
+    there is no padding to clear.
+    """
+    width = int(lengths.max()) if len(lengths) else 0
+    if width == 0:
+        return (np.zeros((len(starts), 0), dtype=np.uint8),
+                np.zeros((len(starts), 0), dtype=bool))
+
+    if int(starts.max()) + width > len(data):
+        # the rows of the last ranges extend past the end of data
+        data = np.concatenate([data, np.zeros(width, dtype=np.uint8)])
+    matrix = np.lib.stride_tricks.sliding_window_view(data, width)[starts]
+    if int(lengths.min()) == width:
+        return matrix, np.ones(matrix.shape, dtype=bool)
+
+    mask = np.arange(width, dtype=np.int32) < \
+        lengths.astype(np.int32)[:, None]
+    np.multiply(matrix, mask, out=matrix)
+    return matrix, mask
+
+
+class _FastqBatch:
+    """A batch of FASTQ records backed by a single decompressed buffer
+
+    Records are described by the offsets of their stripped header, sequence,
+    quality header and quality lines within ``buffer``, and by the raw byte
+    range of the whole record (including line terminators).
+    """
+    def __init__(self, buffer, line_starts, line_ends, record_starts,
+                 record_ends, phred_offset):
+        self.buffer = buffer
+        self.data = np.frombuffer(buffer, dtype=np.uint8)
+        self.line_starts = line_starts
+        self.line_ends = line_ends
+        self.record_starts = record_starts
+        self.record_ends = record_ends
+        self.phred_offset = phred_offset
+
+    @classmethod
+    def from_newlines(cls, buffer, newlines, phred_offset):
+        """Build a batch from the positions of the newlines of 4n lines"""
+        newlines = newlines.astype(np.int64)
+        starts = np.empty_like(newlines)
+        starts[0] = 0
+        starts[1:] = newlines[:-1] + 1
+        ends = newlines.copy()
+        _strip_bounds(np.frombuffer(buffer, dtype=np.uint8), starts, ends)
+
+        n_records = len(newlines) // 4
+        record_ends = newlines[3::4] + 1
+        record_starts = np.empty(n_records, dtype=np.int64)
+        record_starts[:1] = 0
+        record_starts[1:] = record_ends[:-1]
+        return cls(buffer, starts.reshape(n_records, 4),
+                   ends.reshape(n_records, 4), record_starts, record_ends,
+                   phred_offset)
+
+    def __len__(self):
+        return len(self.record_starts)
+
+    def __getitem__(self, key):
+        """Slice records, sharing the underlying buffer"""
+        return type(self)(self.buffer, self.line_starts[key],
+                          self.line_ends[key], self.record_starts[key],
+                          self.record_ends[key], self.phred_offset)
+
+    @property
+    def lengths(self):
+        return self.line_ends[:, 1] - self.line_starts[:, 1]
+
+    @property
+    def verbatim(self):
+        """Whether each record is stored exactly as _format_records writes it
+
+        That is, as its four stripped lines each followed by a newline.
+        """
+        starts = self.line_starts
+        ends = self.line_ends
+        return ((starts[:, 0] == self.record_starts) &
+                (ends[:, 3] + 1 == self.record_ends) &
+                (ends[:, :3] + 1 == starts[:, 1:]).all(axis=1))
+
+    @functools.cached_property
+    def seq(self):
+        """The base calls of the batch as a zero padded matrix"""
+        starts = self.line_starts[:, 1]
+        seq, self.seq_mask = _gather(self.data, starts, self.lengths)
+        return seq
+
+    @functools.cached_property
+    def qual(self):
+        """The PHRED scores of the batch as a zero padded matrix"""
+        starts = self.line_starts[:, 3]
+        qual, self.qual_mask = _gather(self.data, starts,
+                                       self.line_ends[:, 3] - starts)
+        offset = np.uint8(self.phred_offset)
+        if self.qual_mask.all():
+            qual -= offset
+        else:
+            # the padding is left at zero
+            np.subtract(qual, offset, out=qual, where=self.qual_mask)
+        return qual
+
+    def line(self, index, line):
+        return self.buffer[self.line_starts[index, line]:
+                           self.line_ends[index, line]]
+
+    def record(self, index):
+        """Return a record in the form yielded by _read_fastq_seqs"""
+        qual = self.line(index, 3)
+        return (self.line(index, 0), self.line(index, 1),
+                self.line(index, 2), qual,
+                self.qual[index, :len(qual)].copy())
+
+
+def _iter_record_blocks(fh, block_size=_BLOCK_SIZE, head=b''):
+    """Read a decompressed FASTQ stream in blocks of whole records
+
+    Yields (buffer, newlines) pairs where newlines holds the positions of the
+    newlines terminating the 4n lines of the whole records at the start of
+    buffer. An incomplete trailing record is carried over into the next
+    block. head is data already read from the stream.
+    """
+    remainder = head
+    while True:
+        block = fh.read(block_size)
+        buffer = remainder + block if remainder else block
+        if not block:
+            if not buffer.strip():
+                return
+            if not buffer.endswith(b'\n'):
+                buffer += b'\n'
+
+        newlines = np.flatnonzero(
+            np.frombuffer(buffer, dtype=np.uint8) == ord('\n'))
+        n_records = len(newlines) // 4
+
+        if n_records > 0:
+            newlines = newlines[:4 * n_records]
+            yield buffer, newlines
+            remainder = buffer[newlines[-1] + 1:]
+        else:
+            remainder = buffer
+
+        if not block:
+            if remainder.strip():
+                raise ValueError('The FASTQ data ends with an incomplete '
+                                 'record.')
+            return
+
+
+def _iter_fastq_batches(fh, phred_offset, block_size=_BLOCK_SIZE, head=b''):
+    """Parse a decompressed FASTQ stream into batches of records
+
+    Large blocks are read from the stream and record boundaries are found
+    with a single vectorized scan for newlines.
+    """
+    for buffer, newlines in _iter_record_blocks(fh, block_size, head):
+        yield _FastqBatch.from_newlines(buffer, newlines, phred_offset)
+
+
+def _read_fastq_batches(filepath, phred_offset, block_size=_BLOCK_SIZE):
+    with _BACKEND.open(filepath) as fh:
+        yield from _iter_fastq_batches(fh, phred_offset, block_size)
+
+
+def _find_record_start(data, preceding):
+    """Find the first record starting in data
+
+    preceding is the byte before data, or None if data starts a file. A
+    record is recognised by a line starting with @ whose second following
+    line starts with +: a quality line starting with @ is followed by a
+    header and a sequence, and sequences never start with +. Returns None if
+    data does not hold enough lines to decide.
+    """
+    if preceding is None:
+        return 0
+
+    array = np.frombuffer(data, dtype=np.uint8)
+    line_starts = np.flatnonzero(array == ord('\n')) + 1
+    if preceding == b'\n':
+        line_starts = np.concatenate([[0], line_starts])
+
+    for index in range(len(line_starts) - 2):
+        start, plus = line_starts[index], line_starts[index + 2]
+        if plus >= len(data):
+            break
+        if data[start:start + 1] == b'@' and data[plus:plus + 1] == b'+':
+            return int(start)
+    return None
+
+
+def _read_fastq_chunk(chunk, phred_offset, block_size=_BLOCK_SIZE):
+    """Parse the records which start within a chunk of a BGZF file
+
+    The last record may extend past the end of the chunk; the records of
+    consecutive chunks are therefore disjoint and cover the whole file.
+    """
+    with _open_bgzf_chunk(chunk) as fh:
+        preceding = None if chunk.first else fh.read(1)
+
+        data = b''
+        while True:
+            block = fh.read(block_size)
+            data += block
+            start = _find_record_start(data, preceding)
+            if start is not None or not block:
+                break
+        if start is None or start >= chunk.size:
+            return
+
+        # the offset of each batch relative to the start of the chunk
+        offset = start
+        for buffer, newlines in _iter_record_blocks(fh, block_size,
+                                                    data[start:]):
+            batch = _FastqBatch.from_newlines(buffer, newlines, phred_offset)
+            owned = int(np.searchsorted(offset + batch.record_starts,
+                                        chunk.size))
+            if owned < len(batch):
+                if owned > 0:
+                    yield batch[:owned]
+                return
+            yield batch
+            offset += int(batch.record_ends[-1])
+
 
 def _read_fastq_seqs(filepath, phred_offset):
-    # This function is adapted from @jairideout's SO post:
-    # http://stackoverflow.com/a/39302117/3424666
-    fh = gzip.open(filepath, 'rb')
-    for seq_header, seq, qual_header, qual in itertools.zip_longest(*[fh] * 4):
-        qual = qual.strip()
-        qual_parsed = np.frombuffer(memoryview(qual), dtype=np.uint8)
-        qual_parsed = qual_parsed - phred_offset
-        yield (seq_header.strip(), seq.strip(), qual_header.strip(),
-               qual, qual_parsed)
+    for batch in _read_fastq_batches(filepath, phred_offset):
+        for index in range(len(batch)):
+            yield batch.record(index)
 
 
 def _runs_of_ones(arr):
@@ -52,40 +319,1021 @@ def _truncate(sequence_record, position):
     return (sequence_record[0], seq, sequence_record[2], qual, qual_parsed)
 
 
+def _first_bad_window(qual, mask, min_quality, quality_window):
+    """Find where the first run of more than quality_window low scores begins
+
+    The scores of a whole batch are processed at once: the length of the run
+    of low scores ending at each position is derived from a cumulative count
+    which is reset at every acceptable score. Reads without such a run are
+    reported at position -1.
+    """
+    # NOTE: QIIME 1.x used <= the quality threshold and the parameter
+    #   -q was interpreted as the maximum unacceptable PHRED score. In
+    #   QIIME 2.x, we're now interpreting this as the minimum
+    #   acceptable score.
+    # argmax is undefined without positions, as in a batch of empty reads
+    if qual.size == 0:
+        return np.full(len(qual), -1)
+    below = (qual < min_quality) & mask
+    counts = np.cumsum(below, axis=1, dtype=np.int32)
+    resets = np.where(below, 0, counts)
+    np.maximum.accumulate(resets, axis=1, out=resets)
+    run_lengths = counts - resets
+
+    window = max(quality_window, 0)
+    bad = run_lengths > window
+    has_bad = bad.any(axis=1)
+    return np.where(has_bad, bad.argmax(axis=1) - window, -1)
+
+
+def _first_bad_mean(qual, mask, min_quality, quality_window):
+    """Find the first window of quality_window scores with a low mean
+
+    This is the SLIDINGWINDOW rule of Trimmomatic. The sum of each window is
+    the difference of two cumulative sums, so every window of a batch is
+    evaluated at once. Only windows lying wholly within a read are
+    considered, and reads without a low window are reported at position -1.
+    """
+    window = max(quality_window, 1)
+    if window > qual.shape[1]:
+        return np.full(len(qual), -1)
+
+    sums = np.zeros((len(qual), qual.shape[1] + 1), dtype=np.int32)
+    np.cumsum(qual, axis=1, out=sums[:, 1:])
+    # a mean below min_quality is a sum below min_quality * window
+    bad = (sums[:, window:] - sums[:, :-window]) < min_quality * window
+    bad &= mask[:, window - 1:]
+    has_bad = bad.any(axis=1)
+    return np.where(has_bad, bad.argmax(axis=1), -1)
+
+
+def _mott_position(qual, mask, min_quality, quality_window):
+    """Find where the 3' end of each read is trimmed by the BWA algorithm
+
+    Scanning from the 3' end, min_quality - q is summed over the scores q,
+    stopping once the sum is negative; the read is trimmed where the sum
+    was greatest. The sums of a batch are reverse cumulative sums, and the
+    scan stopping is a reverse cumulative minimum, so no read is scanned in
+    Python. quality_window is not used. Reads whose sum is never positive
+    are reported at position -1.
+    """
+    if qual.size == 0:
+        return np.full(len(qual), -1)
+    scores = np.where(mask, min_quality - qual.astype(np.int32), 0)
+    sums = np.cumsum(scores[:, ::-1], axis=1)[:, ::-1]
+    reached = np.minimum.accumulate(sums[:, ::-1], axis=1)[:, ::-1] >= 0
+    candidates = np.where(reached & mask, sums, 0)
+    # ties go to the position nearest the 3' end, which is scanned first
+    best = qual.shape[1] - 1 - candidates[:, ::-1].argmax(axis=1)
+    return np.where(candidates.max(axis=1, initial=0) > 0, best, -1)
+
+
+# the rules which decide where a read is truncated, by trim_mode. Each
+# returns the position at which each read of a batch is truncated, or -1.
+_trimmers = {
+    'consecutive': _first_bad_window,
+    'sliding-window': _first_bad_mean,
+    'mott': _mott_position,
+}
+
+
+def _rounded_fractions(numerators, denominators, ndigits=3):
+    """round(numerator / denominator, ndigits) for arrays of integers
+
+    Python's round is applied to each distinct pair so that the result is
+    identical to rounding one read at a time.
+    """
+    if len(numerators) == 0:
+        return np.empty(0, dtype=float)
+    pairs, inverse = np.unique(np.stack([numerators, denominators]), axis=1,
+                               return_inverse=True)
+    rounded = np.array([round(n / d, ndigits) for n, d in pairs.T.tolist()])
+    return rounded[inverse.ravel()]
+
+
+def _count_ambiguous(batch, lengths):
+    """Count the N base calls within the first lengths bases of each read"""
+    starts = batch.line_starts[:, 1]
+    seqs, mask = _gather(batch.data, starts, lengths)
+    return np.count_nonzero((seqs == ord('N')) & mask, axis=1)
+
+
+def _count_ambiguous_spans(batch, lengths):
+    """_count_ambiguous, summing over the buffer rather than gathering reads
+
+    The N base calls of the buffer are summed between the bounds of each
+    read by np.add.reduceat, so the cost follows the size of the buffer
+    spanned by the reads rather than their number and length.
+    """
+    if len(batch) == 0:
+        return np.zeros(0, dtype=np.int64)
+    starts = batch.line_starts[:, 1]
+    # padded so that the end of the final read is a valid bound
+    is_n = np.zeros(len(batch.data) + 1, dtype=bool)
+    np.equal(batch.data, ord('N'), out=is_n[:-1])
+    bounds = np.stack([starts, starts + lengths], axis=1).ravel()
+    # summing bytes into int32 is several times faster than bools into int64
+    counts = np.add.reduceat(is_n.view(np.uint8), bounds,
+                             dtype=np.int32)[::2].astype(np.int64)
+    # reduceat yields the element at an empty range rather than zero
+    counts[lengths == 0] = 0
+    return counts
+
+
+# the probability that a base call is wrong, indexed by its PHRED score
+_ERROR_PROBABILITIES = 10.0 ** (-np.arange(256) / 10)
+
+
+def _expected_errors(qual, lengths):
+    """The expected number of errors within the first lengths bases of reads
+
+    qual holds the uint8 PHRED scores of the reads, each of which indexes
+    _ERROR_PROBABILITIES.
+    """
+    probabilities = _ERROR_PROBABILITIES[qual]
+    probabilities[np.arange(qual.shape[1]) >= lengths[:, None]] = 0
+    return probabilities.sum(axis=1)
+
+
+def _poly_g_start(seq, mask, min_length, max_mismatches):
+    """Find where a trailing run of G base calls begins in each read
+
+    Two-colour chemistry calls G where there is no signal, with high
+    quality. A tail is the longest suffix of a read which starts with G and
+    holds at most max_mismatches other base calls; it is only reported if it
+    is at least min_length long. The other base calls following each
+    position are counted by a reverse cumulative sum over the batch. Reads
+    without a tail are reported at position -1.
+    """
+    if seq.size == 0:
+        return np.full(len(seq), -1)
+    is_g = seq == ord('G')
+    others = np.cumsum((mask & ~is_g)[:, ::-1], axis=1,
+                       dtype=np.int32)[:, ::-1]
+    candidates = is_g & mask & (others <= max_mismatches)
+    starts = candidates.argmax(axis=1)
+    found = candidates.any(axis=1) & \
+        (mask.sum(axis=1) - starts >= min_length)
+    return np.where(found, starts, -1)
+
+
+class _BatchResult(collections.namedtuple(
+        '_BatchResult', ['lengths', 'truncated', 'poly_g', 'too_short',
+                         'ambiguous', 'too_many_errors', 'kept'])):
+    __slots__ = ()
+
+    @property
+    def trimmed(self):
+        """Whether each read was shortened"""
+        return self.truncated | self.poly_g
+
+
+def _measure_batch(batch, min_quality, quality_window,
+                   trim_mode='consecutive'):
+    """The _ReadMeasures of every read of a batch"""
+    full_lengths = batch.lengths
+    positions = _trimmers[trim_mode](batch.qual, batch.qual_mask,
+                                     min_quality, quality_window)
+    lengths = np.where(positions >= 0, np.minimum(positions, full_lengths),
+                       full_lengths)
+    return _ReadMeasures(full_lengths, positions,
+                         _count_ambiguous(batch, lengths))
+
+
+def _filter_batch(batch, min_quality, quality_window, min_length_fraction,
+                  max_ambiguous, measures=None, trim_mode='consecutive',
+                  max_expected_errors=None, max_expected_errors_per_base=None,
+                  poly_g_min_length=None, poly_g_max_mismatches=1,
+                  count_ambiguous=_count_ambiguous):
+    """Apply the quality filter to every read of a batch
+
+    Returns the length of each read following truncation and boolean masks
+    of the reads which were truncated, had a poly-G tail trimmed beyond
+    that, were too short following truncation, had too many ambiguous base
+    calls, had too many expected errors following truncation, and were
+    kept. A read is only attributed to the first of these filters it fails.
+    Reads are truncated by the rule of _trimmers named by trim_mode, and
+    poly-G tails are only trimmed if poly_g_min_length is given. If the
+    _ReadMeasures of the batch are known, the quality scores are only
+    examined to count expected errors. Each filter is only evaluated on the
+    reads which passed those before it, and ambiguous base calls are counted
+    by count_ambiguous.
+    """
+    if measures is None:
+        full_lengths = batch.lengths
+        positions = _trimmers[trim_mode](batch.qual, batch.qual_mask,
+                                         min_quality, quality_window)
+    else:
+        full_lengths, positions, _ = measures
+
+    # if there is a run of sufficient size, truncate it
+    truncated = positions >= 0
+    lengths = np.where(truncated, np.minimum(positions, full_lengths),
+                       full_lengths)
+
+    # trim a poly-G tail which the truncation left in place, which is found
+    # relative to the truncated end of the read
+    poly_g = np.zeros(len(batch), dtype=bool)
+    if poly_g_min_length is not None:
+        seq = batch.seq
+        mask = batch.seq_mask & \
+            (np.arange(seq.shape[1]) < lengths[:, None])
+        starts = _poly_g_start(seq, mask, poly_g_min_length,
+                               poly_g_max_mismatches)
+        poly_g = (starts >= 0) & (starts < lengths)
+        lengths = np.where(poly_g, starts, lengths)
+
+    # do not keep the read if it is too short following truncation
+    too_short = np.zeros(len(batch), dtype=bool)
+    trimmed = truncated | poly_g
+    too_short[trimmed] = _rounded_fractions(
+        lengths[trimmed], full_lengths[trimmed]) <= min_length_fraction
+
+    # do not keep the read if there are too many ambiguous bases
+    ambiguous = np.zeros(len(batch), dtype=bool)
+    remaining = ~too_short
+    if measures is None or poly_g.any():
+        n_ambiguous = count_ambiguous(batch[remaining], lengths[remaining])
+    else:
+        n_ambiguous = measures.n_ambiguous[remaining]
+    ambiguous[remaining] = n_ambiguous > max_ambiguous
+    remaining &= ~ambiguous
+
+    # do not keep the read if too many errors are expected in it, in total
+    # or per base
+    too_many_errors = np.zeros(len(batch), dtype=bool)
+    if max_expected_errors is not None or \
+            max_expected_errors_per_base is not None:
+        errors = _expected_errors(batch.qual[remaining], lengths[remaining])
+        exceeding = np.zeros(len(errors), dtype=bool)
+        if max_expected_errors is not None:
+            exceeding |= errors > max_expected_errors
+        if max_expected_errors_per_base is not None:
+            exceeding |= errors > (max_expected_errors_per_base *
+                                   lengths[remaining])
+        too_many_errors[remaining] = exceeding
+
+    kept = remaining & ~too_many_errors
+    return _BatchResult(lengths, truncated, poly_g, too_short, ambiguous,
+                        too_many_errors, kept)
+
+
+def _format_records(batch, result):
+    """Serialize the kept records of a batch as FASTQ text
+
+    Returns a list of bytes-like pieces. Runs of consecutive kept records
+    which are not truncated and are stored verbatim are referenced as slices
+    of the batch's buffer without copying; other records are reassembled
+    from their stripped lines.
+    """
+    kept = np.flatnonzero(result.kept)
+    trimmed = result.trimmed
+    verbatim = (batch.verbatim & ~trimmed)[kept]
+
+    # a run of verbatim records continues while records are adjacent in the
+    # buffer, which records adjacent in a subsampled batch need not be
+    continues = np.zeros(len(kept), dtype=bool)
+    continues[1:] = (batch.record_starts[kept[1:]] ==
+                     batch.record_ends[kept[:-1]]) & \
+        verbatim[1:] & verbatim[:-1]
+    firsts = np.flatnonzero(~continues)
+    lasts = np.append(firsts[1:], len(kept)) - 1
+
+    # trimmed reads retain the sequence and quality up to their new length
+    rebuilt = kept[~verbatim]
+    starts = batch.line_starts[rebuilt]
+    ends = batch.line_ends[rebuilt].copy()
+    trimmed = trimmed[rebuilt]
+    lengths = result.lengths[rebuilt][trimmed]
+    for line in (1, 3):
+        ends[trimmed, line] = np.minimum(ends[trimmed, line],
+                                         starts[trimmed, line] + lengths)
+
+    buffer = batch.buffer
+    records = iter([b'\n'.join([buffer[start:end] for start, end
+                                in zip(line_starts, line_ends)]) + b'\n'
+                    for line_starts, line_ends
+                    in zip(starts.tolist(), ends.tolist())])
+
+    view = memoryview(buffer)
+    record_starts = batch.record_starts[kept[firsts]].tolist()
+    record_ends = batch.record_ends[kept[lasts]].tolist()
+    pieces = []
+    for first, start, end in zip(firsts.tolist(), record_starts,
+                                 record_ends):
+        if verbatim[first]:
+            pieces.append(view[start:end])
+        else:
+            pieces.append(next(records))
+    return pieces
+
+
 # defaults as used Bokulich et al, Nature Methods 2013,
 # same as QIIME 1.9.1
 _default_params = {
     'min_quality': 4,
     'quality_window': 3,
     'min_length_fraction': 0.75,
-    'max_ambiguous': 0
+    'max_ambiguous': 0,
+    'compression_level': 9,
+    'trim_mode': 'consecutive',
+    'retention_sample_size': 10000,
+    'retention_confidence': 0.99,
+    'subsample_seed': 0
 }
 
+# the parameters of the filtering actions which are passed on as params
+_filter_param_names = ('min_quality', 'quality_window', 'min_length_fraction',
+                       'max_ambiguous', 'compression_level',
+                       'truncation_index', 'trim_mode', 'max_expected_errors',
+                       'max_expected_errors_per_base', 'poly_g_min_length',
+                       'poly_g_max_mismatches', 'min_retention',
+                       'retention_sample_size', 'retention_confidence',
+                       'max_reads_per_sample', 'subsample_fraction',
+                       'subsample_seed')
 
-# TODO: fix up demux fmt writing a la q2-cutadapt
-def q_score(demux: SingleLanePerSampleSingleEndFastqDirFmt,
-            min_quality: int = _default_params['min_quality'],
-            quality_window: int = _default_params['quality_window'],
-            min_length_fraction:
-            float = _default_params['min_length_fraction'],
-            max_ambiguous: int = _default_params['max_ambiguous']) \
-                  -> (SingleLanePerSampleSingleEndFastqDirFmt,
-                      pd.DataFrame):
-    result = SingleLanePerSampleSingleEndFastqDirFmt()
 
-    manifest = FastqManifestFormat()
-    manifest_fh = manifest.open()
-    manifest_fh.write('sample-id,filename,direction\n')
-    manifest_fh.write('# direction is not meaningful in this file as these\n')
-    manifest_fh.write('# data may be derived from forward, reverse, or \n')
-    manifest_fh.write('# joined reads\n')
+def _filter_params(arguments, **extra):
+    """The params of a filtering action, from its arguments keyed by name
+
+    Only the parameters the action has are included, along with extra.
+    """
+    params = {name: arguments[name] for name in _filter_param_names
+              if name in arguments}
+    params.update(extra)
+    return params
+
+
+_stats_columns = ['total-input-reads', 'total-retained-reads',
+                  'reads-truncated',
+                  'reads-too-short-after-truncation',
+                  'reads-exceeding-maximum-ambiguous-bases']
+
+
+def _expected_errors_enabled(params):
+    return params.get('max_expected_errors') is not None or \
+        params.get('max_expected_errors_per_base') is not None
+
+
+def _poly_g_enabled(params):
+    return params.get('poly_g_min_length') is not None
+
+
+def _retention_estimate_enabled(params):
+    return params.get('min_retention') is not None
+
+
+def _read_cap_enabled(params):
+    return params.get('max_reads_per_sample') is not None
+
+
+def _subsampling_enabled(params):
+    return params.get('subsample_fraction') is not None
+
+
+def _processing_reported(params):
+    return _retention_estimate_enabled(params) or _read_cap_enabled(params)
+
+
+# columns which are only reported when the filter they count is enabled by
+# the parameters, in the order they are reported
+_optional_stats_columns = {
+    'reads-poly-g-trimmed': _poly_g_enabled,
+    'reads-exceeding-maximum-expected-errors': _expected_errors_enabled,
+    'reads-not-subsampled': _subsampling_enabled,
+    'processing': _processing_reported,
+}
+
+
+def _new_counts(params):
+    """Zeroed stats of the columns reported with params
+
+    If params requests a profile, the stats also hold the _QualityProfile
+    of the reads under 'quality-profile'.
+    """
+    columns = _stats_columns + [column for column, enabled
+                                in _optional_stats_columns.items()
+                                if enabled(params)]
+    counts = dict.fromkeys(columns, 0)
+    if 'processing' in counts:
+        # 'estimated' for samples rejected by their estimated retention and
+        # 'capped' for those read up to max_reads_per_sample only
+        counts['processing'] = 'full'
+    if params.get('profile'):
+        counts['quality-profile'] = _QualityProfile()
+    return counts
+
+
+def _retention_upper_bound(kept, total, confidence):
+    """The upper Wilson score bound of a retention rate
+
+    kept of total reads were retained, and the true rate of the sample lies
+    below the bound with probability confidence. Without any reads, nothing
+    bounds the rate.
+    """
+    if total == 0:
+        return 1.0
+    z = statistics.NormalDist().inv_cdf(confidence)
+    rate = kept / total
+    spread = z * (rate * (1 - rate) / total +
+                  z * z / (4 * total * total)) ** 0.5
+    return (rate + z * z / (2 * total) + spread) / (1 + z * z / total)
+
+
+def _filtered_reads(counts):
+    """The number of reads counted in stats which went through the filter"""
+    return counts['total-input-reads'] - counts.get('reads-not-subsampled', 0)
+
+
+def _rejected_by_estimate(params, counts):
+    """Whether a sample is hopeless judging by the reads filtered so far"""
+    return _retention_upper_bound(
+        counts['total-retained-reads'], _filtered_reads(counts),
+        params.get('retention_confidence',
+                   _default_params['retention_confidence'])) < \
+        params['min_retention']
+
 
-    log_records_truncated_counts = {}
-    log_records_max_ambig_counts = {}
-    log_records_tooshort_counts = {}
-    log_records_totalread_counts = {}
-    log_records_totalkept_counts = {}
+# when filtering in parallel, samples whose compressed input is larger than
+# this are split into chunks of about this many decompressed bytes
+_CHUNK_SIZE = 64 * 1024 * 1024
 
+# the decompressed bytes of the chunks of plain gzip files held while
+# awaiting a worker, whatever the number of workers
+_CHUNK_BUDGET = 512 * 1024 * 1024
+
+
+class _SampleWriter:
+    """Write the kept reads of a sample
+
+    The output is only created once a read is kept, in the event that all
+    sequences for a sample are filtered out; an empty fastq file is not a
+    valid fastq file.
+
+    When input_path is provided, nothing is written while every read seen so
+    far was kept without modification. If that holds for the whole sample,
+    the input file itself is placed at the output path rather than
+    recompressing identical data. Otherwise, the unmodified reads preceding
+    the first modification are copied from the input once it is found.
+
+    When output_path is None, the kept reads are only counted.
+    """
+    def __init__(self, output_path, params, threads=1, input_path=None):
+        self.output_path = output_path
+        self.level = params.get('compression_level',
+                                _default_params['compression_level'])
+        self.threads = threads
+        self.input_path = input_path
+        self.unmodified = input_path is not None and output_path is not None
+        # the number of decompressed bytes of unmodified reads not yet
+        # written
+        self.deferred = 0
+        self.kept = 0
+        self._writer = None
+
+    def _open(self):
+        self._writer = _ParallelGzipWriter(self.output_path, self.threads,
+                                           self.level)
+        if self.deferred:
+            with _BACKEND.open(self.input_path) as fh:
+                remaining = self.deferred
+                while remaining > 0:
+                    data = fh.read(min(remaining, _BLOCK_SIZE))
+                    if not data:
+                        # the parser terminates a final line lacking one
+                        self._writer.write(b'\n')
+                        break
+                    self._writer.write(data)
+                    remaining -= len(data)
+            self.deferred = 0
+
+    def write(self, batch, filtered):
+        n_kept = int(filtered.kept.sum())
+        self.kept += n_kept
+        if self.output_path is None:
+            return
+
+        if self.unmodified:
+            if n_kept == len(batch) and not filtered.trimmed.any() and \
+                    batch.verbatim.all():
+                self.deferred += int(batch.record_ends[-1] -
+                                     batch.record_starts[0])
+                return
+            self.unmodified = False
+
+        if n_kept == 0:
+            return
+
+        if self._writer is None:
+            self._open()
+        self._writer.writelines(_format_records(batch, filtered))
+
+    def close(self, input_size=None, discard=False):
+        """Finish the output
+
+        input_size is the decompressed size of the input; the input file is
+        only used as the output if the reads span all of it. If discard is
+        set, any output is removed instead.
+        """
+        if discard:
+            if self._writer is not None:
+                self._writer.close()
+            if self.output_path is not None and \
+                    os.path.exists(self.output_path):
+                os.remove(self.output_path)
+            self.kept = 0
+            return
+
+        if self.unmodified and self.kept > 0:
+            if self.deferred == input_size:
+                _place_file(self.input_path, self.output_path)
+                return
+            self._open()
+
+        if self._writer is not None:
+            self._writer.close()
+
+
+class _FilterPlan:
+    """How the filter is applied to the batches of a sample with params
+
+    Times each way of counting ambiguous base calls on the first batch and
+    uses the cheaper one for the rest. Also holds the random state with
+    which the reads of the sample are subsampled.
+    """
+    _ambiguous_counters = (_count_ambiguous, _count_ambiguous_spans)
+
+    def __init__(self, params):
+        self.params = params
+        self.trim_mode = params.get('trim_mode', _default_params['trim_mode'])
+        # the seconds taken by each counter on the first batch
+        self.times = {}
+        self.count_ambiguous = None
+        # every sample is subsampled by a generator seeded alike
+        self.rng = None
+        if _subsampling_enabled(params):
+            self.rng = np.random.default_rng(params.get('subsample_seed', 0))
+
+    def _count_ambiguous(self, batch, lengths):
+        if self.count_ambiguous is not None:
+            return self.count_ambiguous(batch, lengths)
+
+        for counter in self._ambiguous_counters:
+            start = time.perf_counter()
+            n_ambiguous = counter(batch, lengths)
+            self.times[counter.__name__] = time.perf_counter() - start
+        self.count_ambiguous = min(self._ambiguous_counters,
+                                   key=lambda c: self.times[c.__name__])
+        return n_ambiguous
+
+    def filter(self, batch, measures=None):
+        """Apply _filter_batch with the params of the plan"""
+        params = self.params
+        return _filter_batch(
+            batch,
+            min_quality=params['min_quality'],
+            quality_window=params['quality_window'],
+            min_length_fraction=params['min_length_fraction'],
+            max_ambiguous=params['max_ambiguous'],
+            measures=measures,
+            trim_mode=self.trim_mode,
+            max_expected_errors=params.get('max_expected_errors'),
+            max_expected_errors_per_base=params.get(
+                'max_expected_errors_per_base'),
+            poly_g_min_length=params.get('poly_g_min_length'),
+            poly_g_max_mismatches=params.get('poly_g_max_mismatches', 1),
+            count_ambiguous=self._count_ambiguous)
+
+
+def _filter_batches(batches, writer, params):
+    """Quality filter batches of reads, writing the kept reads to writer
+
+    Returns the stats of the reads keyed by column.
+    """
+    counts = _new_counts(params)
+    plan = _FilterPlan(params)
+    for batch in batches:
+        writer.write(*_filter_counted(batch, plan, counts))
+    return counts
+
+
+def _filter_counted(batch, plan, counts, index=None):
+    """Apply a _FilterPlan to batch, adding the stats of batch to counts
+
+    If a _TruncationIndex of the sample is given, the measures of the reads
+    are taken from it when it was found and added to it otherwise.
+
+    The reads of batch are first subsampled if the params of the plan ask
+    for it, and filtering ends at the read bringing the retained reads of
+    the sample to max_reads_per_sample. Returns the reads filtered and
+    their _BatchResult.
+    """
+    measures = None
+    if index is not None:
+        if index.found:
+            measures = index.take(len(batch))
+        else:
+            measures = _measure_batch(batch, plan.params['min_quality'],
+                                      plan.params['quality_window'],
+                                      plan.trim_mode)
+            index.add(measures)
+
+    if plan.rng is not None:
+        sampled = plan.rng.random(len(batch)) < \
+            plan.params['subsample_fraction']
+        n_unsampled = len(batch) - int(sampled.sum())
+        counts['total-input-reads'] += n_unsampled
+        counts['reads-not-subsampled'] += n_unsampled
+        batch = batch[sampled]
+        if measures is not None:
+            measures = _ReadMeasures(*(column[sampled]
+                                       for column in measures))
+        if len(batch) == 0:
+            # no read of the batch was drawn, and a plan is not timed on
+            # an empty batch
+            none = np.zeros(0, dtype=bool)
+            return batch, _BatchResult(np.zeros(0, dtype=np.int64),
+                                       *[none] * 6)
+
+    filtered = plan.filter(batch, measures)
+
+    if _read_cap_enabled(plan.params):
+        remaining = plan.params['max_reads_per_sample'] - \
+            counts['total-retained-reads']
+        kept = np.flatnonzero(filtered.kept)
+        if len(kept) >= remaining:
+            end = kept[remaining - 1] + 1 if remaining > 0 else 0
+            batch = batch[:end]
+            filtered = _BatchResult(*(field[:end] for field in filtered))
+
+    _add_counts(counts, filtered)
+    if 'quality-profile' in counts:
+        counts['quality-profile'] += _QualityProfile.from_batch(batch,
+                                                                filtered)
+    return batch, filtered
+
+
+def _add_counts(counts, filtered):
+    """Add the stats of a _BatchResult to counts"""
+    counts['total-input-reads'] += len(filtered.kept)
+    counts['total-retained-reads'] += int(filtered.kept.sum())
+    counts['reads-truncated'] += int(filtered.truncated.sum())
+    counts['reads-too-short-after-truncation'] += \
+        int(filtered.too_short.sum())
+    counts['reads-exceeding-maximum-ambiguous-bases'] += \
+        int(filtered.ambiguous.sum())
+    if 'reads-poly-g-trimmed' in counts:
+        counts['reads-poly-g-trimmed'] += int(filtered.poly_g.sum())
+    if 'reads-exceeding-maximum-expected-errors' in counts:
+        counts['reads-exceeding-maximum-expected-errors'] += \
+            int(filtered.too_many_errors.sum())
+
+
+class _SampleReader:
+    """Decompress and parse the batches of a sample in a background thread
+
+    Reading starts on construction, so a reader may be created for a sample
+    before it is filtered. At most _QUEUE_SIZE batches are read ahead.
+    """
+    def __init__(self, input_path, phred_offset):
+        self.input_path = input_path
+        self.times = _StageTimes('read')
+        # the decompressed size of the input, known once it is fully read
+        self.size = None
+        self.batches = _ReadAhead(self._read(phred_offset), self.times,
+                                  _StageTimes('filter'))
+
+    def _read(self, phred_offset):
+        with _BACKEND.open(self.input_path) as fh:
+            yield from _iter_fastq_batches(fh, phred_offset)
+            self.size = fh.tell()
+
+    def close(self):
+        self.batches.close()
+
+
+def _filter_sample(input_path, output_path, phred_offset, params,
+                   threads=1, reader=None):
+    """Quality filter the reads of one sample
+
+    Decompression and parsing, filtering, and formatting and compression of
+    the output run concurrently in three threads connected by bounded
+    queues. The time each stage spent working and waiting is printed, as
+    the busiest stage bounds the throughput. reader may be a _SampleReader
+    of input_path which has already been started.
+    """
+    counts, = _filter_sample_multi(input_path, [output_path], phred_offset,
+                                   [params], threads, reader)
+    return counts
+
+
+def _filter_sample_multi(input_path, output_paths, phred_offset,
+                         params_list, threads=1, reader=None):
+    """Quality filter one sample once per set of parameters
+
+    As _filter_sample, except that each batch read is filtered with every
+    set of parameters in params_list, and the reads kept by each are written
+    to the corresponding output path by a writer thread of its own. Returns
+    the stats of each set of parameters.
+
+    A set of parameters with a min_retention stops filtering the sample
+    once retention_sample_size reads show that the retention rate is
+    likely below it. Its output is then discarded and its stats, which
+    describe the reads filtered, are marked as estimated. A set of
+    parameters with a max_reads_per_sample stops once it has retained that
+    many reads, and its stats are marked as capped; the reads never read
+    are not counted as input. Reading stops once every set has stopped.
+    """
+    if reader is None:
+        reader = _SampleReader(input_path, phred_offset)
+    filtering = reader.batches.waiting
+    times = [reader.times, filtering]
+
+    start = time.perf_counter()
+    writers = []
+    for output_path, params in zip(output_paths, params_list):
+        times.append(_StageTimes('write'))
+        writers.append(_WriteBehind(
+            # subsampled output is never a copy of the input
+            _SampleWriter(output_path, params, threads,
+                          None if _subsampling_enabled(params)
+                          else input_path),
+            times[-1], filtering))
+    counts = [_new_counts(params) for params in params_list]
+    plans = [_FilterPlan(params) for params in params_list]
+    indexes = [_TruncationIndex(params['truncation_index'], input_path,
+                                phred_offset, params['min_quality'],
+                                params['quality_window'],
+                                params.get('trim_mode',
+                                           _default_params['trim_mode']))
+               if params.get('truncation_index') else None
+               for params in params_list]
+    # the sets whose retention is yet to be estimated, and how each set
+    # stopped before the end of the sample, if it did
+    estimating = [_retention_estimate_enabled(params)
+                  for params in params_list]
+    sample_sizes = [params.get('retention_sample_size',
+                               _default_params['retention_sample_size'])
+                    for params in params_list]
+    stopped = [None] * len(params_list)
+    try:
+        with contextlib.closing(reader):
+            for batch in reader.batches:
+                for i, (params, plan, writer, sample_counts, index) in \
+                        enumerate(zip(params_list, plans, writers, counts,
+                                      indexes)):
+                    remaining = batch
+                    while len(remaining) and not stopped[i]:
+                        # the retention is estimated from exactly
+                        # retention_sample_size reads, after which the
+                        # rest of the batch is filtered if the sample passes
+                        piece = remaining
+                        if estimating[i]:
+                            piece = remaining[:sample_sizes[i] -
+                                              _filtered_reads(sample_counts)]
+                        remaining = remaining[len(piece):]
+                        writer.write(*_filter_counted(piece, plan,
+                                                      sample_counts, index))
+                        if _read_cap_enabled(params) and \
+                                sample_counts['total-retained-reads'] >= \
+                                params['max_reads_per_sample']:
+                            stopped[i] = 'capped'
+                        elif estimating[i] and \
+                                _filtered_reads(sample_counts) >= \
+                                sample_sizes[i]:
+                            estimating[i] = False
+                            if _rejected_by_estimate(params, sample_counts):
+                                stopped[i] = 'estimated'
+                if all(stopped):
+                    break
+    finally:
+        for writer in writers:
+            writer.join()
+    # the indexes of stopped sets do not describe the whole sample
+    for index, set_stopped in zip(indexes, stopped):
+        if index is not None and not set_stopped:
+            index.finish()
+    filtering.busy = time.perf_counter() - start - filtering.idle
+    for writer, sample_counts, set_stopped in zip(writers, counts, stopped):
+        rejected = set_stopped == 'estimated'
+        writer.close(input_size=reader.size, discard=rejected)
+        if rejected:
+            sample_counts['total-retained-reads'] = 0
+        if set_stopped:
+            sample_counts['processing'] = set_stopped
+
+    print('%s: %s' % (os.path.basename(input_path),
+                      '; '.join(str(stage) for stage in times)))
+    return counts
+
+
+def _filter_chunk(chunk, output_path, phred_offset, params):
+    """Quality filter the reads of a chunk produced by _iter_chunks"""
+    if isinstance(chunk, bytes):
+        batches = _iter_fastq_batches(io.BytesIO(chunk), phred_offset)
+    else:
+        batches = _read_fastq_chunk(chunk, phred_offset)
+    writer = _SampleWriter(output_path, params)
+    counts = _filter_batches(batches, writer, params)
+    writer.close()
+    return counts
+
+
+def _iter_chunks(input_path, chunk_size):
+    """Split a sample into chunks which can be filtered independently
+
+    The blocks of a BGZF file can be decompressed independently, so these
+    chunks only describe a range of the file. Other gzip files cannot be
+    entered part way through, so they are decompressed here and handed out
+    as blocks of whole records.
+    """
+    chunks = _bgzf_chunks(input_path, chunk_size)
+    if chunks is not None:
+        yield from chunks
+        return
+
+    with _BACKEND.open(input_path) as fh:
+        for buffer, newlines in _iter_record_blocks(fh, chunk_size):
+            yield buffer[:newlines[-1] + 1]
+
+
+def _merge_chunks(chunks, output_path, params):
+    """Concatenate the outputs and sum the stats of the chunks of a sample
+
+    chunks holds a (future, output path) pair per chunk. The output of each
+    chunk is a complete gzip member, so concatenating them forms a valid
+    gzip file.
+    """
+    counts = _new_counts(params)
+    writer = None
+    for future, part_path in chunks:
+        for column, count in future.result().items():
+            counts[column] += count
+
+        if part_path is not None and os.path.exists(part_path):
+            if writer is None:
+                writer = open(output_path, 'wb')
+            with open(part_path, 'rb') as part:
+                shutil.copyfileobj(part, writer)
+            os.remove(part_path)
+
+    if writer is not None:
+        writer.close()
+
+    return counts
+
+
+def _filter_prefetched(samples, phred_offset, params, prefetch, done=None):
+    """Quality filter samples in order, reading up to prefetch samples ahead
+
+    The inputs of the next prefetch samples are opened and decompressed in
+    background threads while the current sample is filtered, so that the
+    cost of opening many small files is hidden. Each reader holds at most
+    _QUEUE_SIZE batches, which bounds the memory used. done is called with
+    the index and stats of each sample as it completes.
+    """
+    readers = collections.deque()
+    pending = iter(samples)
+    try:
+        results = []
+        for input_path, output_path in samples:
+            while len(readers) <= prefetch:
+                upcoming = next(pending, None)
+                if upcoming is None:
+                    break
+                readers.append(_SampleReader(upcoming[0], phred_offset))
+            results.append(_filter_sample(input_path, output_path,
+                                          phred_offset, params,
+                                          reader=readers.popleft()))
+            if done is not None:
+                done(len(results) - 1, results[-1])
+        return results
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+def _filter_samples(samples, phred_offset, params, n_jobs,
+                    chunk_size=_CHUNK_SIZE, prefetch=0, done=None,
+                    chunk_budget=_CHUNK_BUDGET):
+    """Quality filter (input path, output path) pairs of samples
+
+    Returns the stats of each sample, in order. When n_jobs > 1, samples are
+    filtered in separate processes and large samples are split into chunks
+    which are filtered in parallel before their results are merged. Cores
+    not needed for filtering are used to compress the outputs. Otherwise,
+    the samples are filtered in this process while up to prefetch of the
+    samples following each are read ahead.
+
+    done is called with the index and stats of each sample once its output
+    is complete, in the order of the samples. Samples whose output path is
+    None are filtered without writing their reads. The chunks decompressed
+    here and awaiting a worker hold at most chunk_budget bytes.
+    """
+    if n_jobs == 1:
+        return _filter_prefetched(samples, phred_offset, params, prefetch,
+                                  done)
+
+    threads = max(1, n_jobs // len(samples)) if samples else 1
+    results = [None] * len(samples)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as \
+            executor, tempfile.TemporaryDirectory() as temp_dir:
+        large = []
+        for index, (input_path, output_path) in enumerate(samples):
+            # a truncation index describes a sample as a whole, the
+            # retention of a sample is estimated from its first reads, and
+            # reads are capped and subsampled in the order they are read
+            if os.path.getsize(input_path) > chunk_size and \
+                    not params.get('truncation_index') and \
+                    not _retention_estimate_enabled(params) and \
+                    not _read_cap_enabled(params) and \
+                    not _subsampling_enabled(params):
+                large.append(index)
+            else:
+                results[index] = executor.submit(
+                    _filter_sample, input_path, output_path, phred_offset,
+                    params, threads)
+
+        # the decompressed bytes held by each chunk awaiting a worker; BGZF
+        # chunks are decompressed by the worker and hold none
+        outstanding = {}
+        for index in large:
+            chunks = []
+            for chunk in _iter_chunks(samples[index][0], chunk_size):
+                size = len(chunk) if isinstance(chunk, bytes) else 0
+                # bound the number and size of chunks held
+                while outstanding and (
+                        len(outstanding) >= 2 * n_jobs or
+                        sum(outstanding.values()) + size > chunk_budget):
+                    finished, _ = concurrent.futures.wait(
+                        outstanding,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in finished:
+                        del outstanding[future]
+
+                part_path = None
+                if samples[index][1] is not None:
+                    part_path = os.path.join(
+                        temp_dir, '%d-%d.fastq.gz' % (index, len(chunks)))
+                future = executor.submit(_filter_chunk, chunk, part_path,
+                                         phred_offset, params)
+                outstanding[future] = size
+                chunks.append((future, part_path))
+            results[index] = chunks
+
+        for index, (result, (_, output_path)) in enumerate(zip(results,
+                                                               samples)):
+            if isinstance(result, list):
+                results[index] = _merge_chunks(result, output_path, params)
+            else:
+                results[index] = result.result()
+            if done is not None:
+                done(index, results[index])
+        return results
+
+
+def _filter_samples_stored(samples, phred_offset, params, n_jobs, prefetch,
+                           stores):
+    """_filter_samples, taking the samples found in any of stores from it
+
+    stores are _ResultCache or _Checkpoint instances. The samples which were
+    not found are added to every store as they complete.
+    """
+    keys = [_sample_key(input_path, phred_offset, params)
+            for input_path, _ in samples]
+    results = []
+    for key, (_, output_path) in zip(keys, samples):
+        counts = None
+        for store in stores:
+            counts = store.get(key, output_path)
+            if counts is not None:
+                break
+        results.append(counts)
+    missing = [i for i, counts in enumerate(results) if counts is None]
+
+    def done(index, counts):
+        index = missing[index]
+        for store in stores:
+            store.put(keys[index], samples[index][1], counts)
+
+    computed = _filter_samples([samples[i] for i in missing], phred_offset,
+                               params, n_jobs, prefetch=prefetch, done=done)
+    for i, counts in zip(missing, computed):
+        results[i] = counts
+
+    if len(missing) < len(samples):
+        print('%d of %d samples were taken from earlier runs'
+              % (len(samples) - len(missing), len(samples)))
+    return results
+
+
+def _read_demux(demux, directions=False):
+    """Returns the phred offset and (sample id, path) of each sample
+
+    If directions is set, the direction of the reads of each file is given
+    as well, as (sample id, path, direction), as paired-end samples have a
+    file per direction.
+    """
     metadata_view = demux.metadata.view(YamlFormat).open()
     phred_offset = yaml.load(metadata_view,
                              Loader=yaml.SafeLoader)['phred-offset']
@@ -93,74 +1341,51 @@ def q_score(demux: SingleLanePerSampleSingleEndFastqDirFmt,
     demux_manifest = pd.read_csv(demux_manifest.open(), dtype=str)
     demux_manifest.set_index('filename', inplace=True)
 
-    iterator = demux.sequences.iter_views(FastqGzFormat)
-    for bc_id, (fname, fp) in enumerate(iterator):
-        sample_id = demux_manifest.loc[str(fname)]['sample-id']
-
-        log_records_truncated_counts[sample_id] = 0
-        log_records_max_ambig_counts[sample_id] = 0
-        log_records_tooshort_counts[sample_id] = 0
-        log_records_totalread_counts[sample_id] = 0
-        log_records_totalkept_counts[sample_id] = 0
-
-        # per q2-demux, barcode ID, lane number and read number are not
-        # relevant here
-        path = result.sequences.path_maker(sample_id=sample_id,
-                                           barcode_id=bc_id,
-                                           lane_number=1,
-                                           read_number=1)
-
-        # we do not open a writer by default in the event that all sequences
-        # for a sample are filtered out; an empty fastq file is not a valid
-        # fastq file.
-        writer = None
-        for sequence_record in _read_fastq_seqs(str(fp), phred_offset):
-            log_records_totalread_counts[sample_id] += 1
-
-            # determine the length of the runs below quality threshold
-            # NOTE: QIIME 1.x used <= the quality threshold and the parameter
-            #   -q was interpreted as the maximum unacceptable PHRED score. In
-            #   QIIME 2.x, we're now interpreting this as the minimum
-            #   acceptable score.
-            qual_below_threshold = sequence_record[4] < min_quality
-            run_starts, run_lengths = _runs_of_ones(qual_below_threshold)
-            bad_windows = np.argwhere(run_lengths > quality_window)
-
-            # if there is a run of sufficient size, truncate it
-            if bad_windows.size > 0:
-                log_records_truncated_counts[sample_id] += 1
-
-                full_length = len(sequence_record[1])
-                sequence_record = _truncate(sequence_record,
-                                            run_starts[bad_windows[0]][0])
-                trunc_length = len(sequence_record[1])
-
-                # do not keep the read if it is too short following truncation
-                if round(trunc_length / full_length, 3) <= min_length_fraction:
-                    log_records_tooshort_counts[sample_id] += 1
-                    continue
-
-            # do not keep the read if there are too many ambiguous bases
-            if sequence_record[1].count(b'N') > max_ambiguous:
-                log_records_max_ambig_counts[sample_id] += 1
-                continue
-
-            fastq_lines = b'\n'.join(sequence_record[:4]) + b'\n'
+    samples = []
+    for fname, fp in demux.sequences.iter_views(FastqGzFormat):
+        entry = demux_manifest.loc[str(fname)]
+        if directions:
+            samples.append((entry['sample-id'], str(fp), entry['direction']))
+        else:
+            samples.append((entry['sample-id'], str(fp)))
+    return phred_offset, samples
 
-            if writer is None:
-                writer = gzip.open(str(path), mode='w')
-            writer.write(fastq_lines)
 
-            log_records_totalkept_counts[sample_id] += 1
+def _sample_paths(result, sample_ids, read_number=1):
+    """The path of each sample's filtered reads within result"""
+    # per q2-demux, barcode ID and lane number are not relevant here, nor
+    # is the read number of single-end reads
+    return [result.sequences.path_maker(sample_id=sample_id,
+                                        barcode_id=bc_id,
+                                        lane_number=1,
+                                        read_number=read_number)
+            for bc_id, sample_id in enumerate(sample_ids)]
 
-        if writer is not None:
-            manifest_fh.write('%s,%s,%s\n' % (sample_id, path.name, 'forward'))
-            writer.close()
 
-    if set(log_records_totalkept_counts.values()) == {0, }:
-        raise ValueError("All sequences from all samples were filtered out. "
-                         "The parameter choices may be too stringent for the "
-                         "data.")
+def _write_manifest(result, sample_ids, paths, sample_counts, phred_offset,
+                    reverse_paths=None):
+    """Write the manifest and metadata of result
+
+    Samples without retained reads are left out of the manifest. If the
+    paths of the reverse reads of paired-end samples are given, they are
+    listed along with the forward reads.
+    """
+    manifest = FastqManifestFormat()
+    manifest_fh = manifest.open()
+    manifest_fh.write('sample-id,filename,direction\n')
+    if reverse_paths is None:
+        manifest_fh.write('# direction is not meaningful in this file as '
+                          'these\n')
+        manifest_fh.write('# data may be derived from forward, reverse, or \n')
+        manifest_fh.write('# joined reads\n')
+
+    for i, (sample_id, path, counts) in enumerate(zip(sample_ids, paths,
+                                                      sample_counts)):
+        if counts['total-retained-reads'] > 0:
+            manifest_fh.write('%s,%s,%s\n' % (sample_id, path.name, 'forward'))
+            if reverse_paths is not None:
+                manifest_fh.write('%s,%s,%s\n' % (
+                    sample_id, reverse_paths[i].name, 'reverse'))
 
     manifest_fh.close()
     result.manifest.write_data(manifest, FastqManifestFormat)
@@ -169,18 +1394,252 @@ def q_score(demux: SingleLanePerSampleSingleEndFastqDirFmt,
     metadata.path.write_text(yaml.dump({'phred-offset': phred_offset}))
     result.metadata.write_data(metadata, YamlFormat)
 
-    columns = ['sample-id', 'total-input-reads', 'total-retained-reads',
-               'reads-truncated',
-               'reads-too-short-after-truncation',
-               'reads-exceeding-maximum-ambiguous-bases']
-    stats = []
-    for id_, _ in sorted(log_records_truncated_counts.items()):
-        stats.append([id_, log_records_totalread_counts[id_],
-                      log_records_totalkept_counts[id_],
-                      log_records_truncated_counts[id_],
-                      log_records_tooshort_counts[id_],
-                      log_records_max_ambig_counts[id_]])
-
-    stats = pd.DataFrame(stats, columns=columns).set_index('sample-id')
-
-    return result, stats
+
+def _all_filtered(sample_counts):
+    return bool(sample_counts) and all(
+        counts['total-retained-reads'] == 0 for counts in sample_counts)
+
+
+def _stats_frame(sample_ids, sample_counts):
+    """The QualityFilterStats of the samples"""
+    columns = _stats_columns + [
+        column for column in _optional_stats_columns
+        if any(column in counts for counts in sample_counts)]
+    stats = pd.DataFrame(sample_counts, index=pd.Index(sample_ids,
+                                                       name='sample-id'),
+                         columns=columns)
+    stats['compression-backend'] = _BACKEND.name
+    stats.sort_index(inplace=True)
+    return stats
+
+
+# TODO: fix up demux fmt writing a la q2-cutadapt
+def q_score(demux: SingleLanePerSampleSingleEndFastqDirFmt,
+            min_quality: int = _default_params['min_quality'],
+            quality_window: int = _default_params['quality_window'],
+            min_length_fraction:
+            float = _default_params['min_length_fraction'],
+            max_ambiguous: int = _default_params['max_ambiguous'],
+            n_jobs: int = 1,
+            compression_level: int = _default_params['compression_level'],
+            prefetch: int = 0,
+            truncation_index: str = None,
+            cache_dir: str = None,
+            cache_max_size: int = 10240,
+            checkpoint_dir: str = None,
+            trim_mode: str = _default_params['trim_mode'],
+            max_expected_errors: float = None,
+            max_expected_errors_per_base: float = None,
+            poly_g_min_length: int = None,
+            poly_g_max_mismatches: int = 1,
+            min_retention: float = None,
+            retention_sample_size:
+            int = _default_params['retention_sample_size'],
+            retention_confidence:
+            float = _default_params['retention_confidence'],
+            max_reads_per_sample: int = None,
+            subsample_fraction: float = None,
+            subsample_seed: int = _default_params['subsample_seed']) \
+                  -> (SingleLanePerSampleSingleEndFastqDirFmt,
+                      pd.DataFrame):
+    params = _filter_params(locals())
+
+    stores = []
+    if checkpoint_dir:
+        stores.append(_Checkpoint(checkpoint_dir))
+    if cache_dir:
+        stores.append(_ResultCache(cache_dir, cache_max_size * 1024 * 1024))
+
+    result, sample_ids, sample_counts = _q_score(demux, params, n_jobs,
+                                                 prefetch, stores)
+    for store in stores:
+        store.finish()
+
+    return result, _stats_frame(sample_ids, sample_counts)
+
+
+def _q_score(demux, params, n_jobs, prefetch, stores=()):
+    """Filter the samples of demux with params, as q_score
+
+    Samples found in any of stores are taken from it. Returns the filtered
+    sequences and the ids and stats of the samples.
+    """
+    result = SingleLanePerSampleSingleEndFastqDirFmt()
+    phred_offset, demux_samples = _read_demux(demux)
+
+    sample_ids = [sample_id for sample_id, _ in demux_samples]
+    paths = _sample_paths(result, sample_ids)
+    samples = [(fp, str(path))
+               for (_, fp), path in zip(demux_samples, paths)]
+
+    # each sample is written by the process filtering it; the manifest and
+    # stats are assembled here in the order the samples were encountered
+    if stores:
+        sample_counts = _filter_samples_stored(samples, phred_offset, params,
+                                               n_jobs, prefetch, stores)
+    else:
+        sample_counts = _filter_samples(samples, phred_offset, params,
+                                        n_jobs, prefetch=prefetch)
+
+    if _all_filtered(sample_counts):
+        raise ValueError("All sequences from all samples were filtered out. "
+                         "The parameter choices may be too stringent for the "
+                         "data.")
+
+    _write_manifest(result, sample_ids, paths, sample_counts, phred_offset)
+    return result, sample_ids, sample_counts
+
+
+def q_score_with_profile(demux: SingleLanePerSampleSingleEndFastqDirFmt,
+                         min_quality: int = _default_params['min_quality'],
+                         quality_window:
+                         int = _default_params['quality_window'],
+                         min_length_fraction:
+                         float = _default_params['min_length_fraction'],
+                         max_ambiguous: int = _default_params['max_ambiguous'],
+                         n_jobs: int = 1,
+                         compression_level:
+                         int = _default_params['compression_level'],
+                         prefetch: int = 0,
+                         trim_mode: str = _default_params['trim_mode'],
+                         max_expected_errors: float = None,
+                         max_expected_errors_per_base: float = None,
+                         poly_g_min_length: int = None,
+                         poly_g_max_mismatches: int = 1) \
+                               -> (SingleLanePerSampleSingleEndFastqDirFmt,
+                                   pd.DataFrame, QualityFilterProfileFmt):
+    params = _filter_params(locals(), profile=True)
+
+    result, sample_ids, sample_counts = _q_score(demux, params, n_jobs,
+                                                 prefetch)
+    profiles = [counts.pop('quality-profile') for counts in sample_counts]
+
+    # samples are ordered as in the stats
+    order = sorted(range(len(sample_ids)), key=lambda i: sample_ids[i])
+    profile = QualityFilterProfileFmt()
+    _write_profile(str(profile), [sample_ids[i] for i in order],
+                   _profile_counts([profiles[i] for i in order]))
+
+    return result, _stats_frame(sample_ids, sample_counts), profile
+
+
+def q_score_stats(demux: SingleLanePerSampleSingleEndFastqDirFmt,
+                  min_quality: int = _default_params['min_quality'],
+                  quality_window: int = _default_params['quality_window'],
+                  min_length_fraction:
+                  float = _default_params['min_length_fraction'],
+                  max_ambiguous: int = _default_params['max_ambiguous'],
+                  n_jobs: int = 1,
+                  prefetch: int = 0,
+                  truncation_index: str = None,
+                  trim_mode: str = _default_params['trim_mode'],
+                  max_expected_errors: float = None,
+                  max_expected_errors_per_base: float = None,
+                  poly_g_min_length: int = None,
+                  poly_g_max_mismatches: int = 1,
+                  min_retention: float = None,
+                  retention_sample_size:
+                  int = _default_params['retention_sample_size'],
+                  retention_confidence:
+                  float = _default_params['retention_confidence'],
+                  max_reads_per_sample: int = None,
+                  subsample_fraction: float = None,
+                  subsample_seed: int = _default_params['subsample_seed']) \
+                        -> pd.DataFrame:
+    params = _filter_params(locals())
+    phred_offset, demux_samples = _read_demux(demux)
+
+    # no reads are written, so the stats are reported even if every read
+    # was filtered out
+    sample_ids = [sample_id for sample_id, _ in demux_samples]
+    samples = [(fp, None) for _, fp in demux_samples]
+    sample_counts = _filter_samples(samples, phred_offset, params, n_jobs,
+                                    prefetch=prefetch)
+
+    return _stats_frame(sample_ids, sample_counts)
+
+
+def _parameter_sets(compression_level, **values):
+    """Pair up the i-th values of each list of parameters
+
+    A list holding a single value applies to every set.
+    """
+    n_sets = max(len(value) for value in values.values())
+    for name, value in values.items():
+        if len(value) not in (1, n_sets):
+            raise ValueError('%s has %d values, but %d parameter sets were '
+                             'specified. Each parameter must have one value '
+                             'or one value per set.'
+                             % (name, len(value), n_sets))
+
+    params_list = []
+    for i in range(n_sets):
+        params = {name: value[i % len(value)]
+                  for name, value in values.items()}
+        params['compression_level'] = compression_level
+        params_list.append(params)
+    return params_list
+
+
+def _parameter_set_key(params):
+    return 'q%s-w%s-f%s-a%s' % (params['min_quality'],
+                                params['quality_window'],
+                                params['min_length_fraction'],
+                                params['max_ambiguous'])
+
+
+def q_score_multi(demux: SingleLanePerSampleSingleEndFastqDirFmt,
+                  min_quality: list = [_default_params['min_quality']],
+                  quality_window: list = [_default_params['quality_window']],
+                  min_length_fraction:
+                  list = [_default_params['min_length_fraction']],
+                  max_ambiguous: list = [_default_params['max_ambiguous']],
+                  n_jobs: int = 1,
+                  compression_level:
+                  int = _default_params['compression_level']) \
+                        -> (SingleLanePerSampleSingleEndFastqDirFmt,
+                            pd.DataFrame):
+    params_list = _parameter_sets(
+        compression_level, min_quality=list(min_quality),
+        quality_window=list(quality_window),
+        min_length_fraction=list(min_length_fraction),
+        max_ambiguous=list(max_ambiguous))
+    keys = [_parameter_set_key(params) for params in params_list]
+    if len(set(keys)) < len(keys):
+        raise ValueError('The parameter sets must be distinct.')
+
+    phred_offset, demux_samples = _read_demux(demux)
+    sample_ids = [sample_id for sample_id, _ in demux_samples]
+    results = [SingleLanePerSampleSingleEndFastqDirFmt()
+               for _ in params_list]
+    paths = [_sample_paths(result, sample_ids) for result in results]
+
+    # every set of parameters is applied to a sample as it is read
+    args = [(fp, [str(set_paths[i]) for set_paths in paths], phred_offset,
+             params_list)
+            for i, (_, fp) in enumerate(demux_samples)]
+    if n_jobs == 1:
+        sample_counts = [_filter_sample_multi(*sample_args)
+                         for sample_args in args]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as \
+                executor:
+            futures = [executor.submit(_filter_sample_multi, *sample_args)
+                       for sample_args in args]
+            sample_counts = [future.result() for future in futures]
+
+    filtered_sequences = {}
+    filter_stats = {}
+    for i, (key, result) in enumerate(zip(keys, results)):
+        set_counts = [counts[i] for counts in sample_counts]
+        if _all_filtered(set_counts):
+            raise ValueError("All sequences from all samples were filtered "
+                             "out with the parameter set %s. The parameter "
+                             "choices may be too stringent for the data."
+                             % key)
+        _write_manifest(result, sample_ids, paths[i], set_counts,
+                        phred_offset)
+        filtered_sequences[key] = result
+        filter_stats[key] = _stats_frame(sample_ids, set_counts)
+
+    return filtered_sequences, filter_stats
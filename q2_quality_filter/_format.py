@@ -6,20 +6,71 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import numpy as np
 import qiime2.plugin.model as model
 
 
 class QualityFilterStatsFmt(model.TextFileFormat):
+    required_columns = ['sample-id', 'total-input-reads',
+                        'total-retained-reads',
+                        'reads-truncated',
+                        'reads-too-short-after-truncation',
+                        'reads-exceeding-maximum-ambiguous-bases']
+    # columns which follow the required columns in files written by newer
+    # versions of q_score
+    optional_columns = ['reads-poly-g-trimmed',
+                        'reads-exceeding-maximum-expected-errors',
+                        'reads-not-subsampled', 'processing',
+                        'compression-backend']
+
     def sniff(self):
         line = open(str(self)).readline()
         hdr = line.strip().split(',')
-        expected = ['sample-id', 'total-input-reads',
-                    'total-retained-reads',
-                    'reads-truncated',
-                    'reads-too-short-after-truncation',
-                    'reads-exceeding-maximum-ambiguous-bases']
-        return hdr == expected
+        n_required = len(self.required_columns)
+        return (hdr[:n_required] == self.required_columns and
+                all(column in self.optional_columns
+                    for column in hdr[n_required:]))
 
 
 QualityFilterStatsDirFmt = model.SingleFileDirectoryFormat(
     'QualityFilterStatsDirFmt', 'stats.csv', QualityFilterStatsFmt)
+
+
+class QualityFilterSweepStatsFmt(model.TextFileFormat):
+    required_columns = ['sample-id', 'min-quality', 'quality-window',
+                        'min-length-fraction', 'max-ambiguous',
+                        'total-input-reads', 'total-retained-reads',
+                        'reads-truncated',
+                        'reads-too-short-after-truncation',
+                        'reads-exceeding-maximum-ambiguous-bases']
+
+    def sniff(self):
+        line = open(str(self)).readline()
+        hdr = line.strip().split(',')
+        return hdr == self.required_columns
+
+
+QualityFilterSweepStatsDirFmt = model.SingleFileDirectoryFormat(
+    'QualityFilterSweepStatsDirFmt', 'sweep.csv', QualityFilterSweepStatsFmt)
+
+
+class QualityFilterProfileFmt(model.BinaryFileFormat):
+    """Counts of the PHRED scores at each position of the reads of samples
+
+    An npz file holding sample_ids and the uint32 array
+    counts[sample, stage, position, score], with the stages before and
+    after filtering.
+    """
+    def sniff(self):
+        try:
+            with np.load(str(self)) as data:
+                return (set(data.files) == {'sample_ids', 'counts'} and
+                        data['counts'].dtype == np.uint32 and
+                        data['counts'].ndim == 4 and
+                        len(data['counts']) == len(data['sample_ids']))
+        except (OSError, ValueError):
+            return False
+
+
+QualityFilterProfileDirFmt = model.SingleFileDirectoryFormat(
+    'QualityFilterProfileDirFmt', 'profile.npz', QualityFilterProfileFmt)
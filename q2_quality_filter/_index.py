@@ -0,0 +1,105 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import collections
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+
+_ReadMeasures = collections.namedtuple(
+    '_ReadMeasures', ['full_lengths', 'positions', 'n_ambiguous'])
+_ReadMeasures.__doc__ = """What the filter needs to know of each read
+
+These depend on min_quality, quality_window and trim_mode only: the length
+of each read, the position at which it is truncated (-1 if it is not) and
+the number of ambiguous base calls in the read following truncation.
+"""
+
+
+# the stored position of a read which is not truncated
+_NOT_TRUNCATED = np.iinfo(np.uint16).max
+
+
+def _digest(path):
+    """The SHA-256 digest of the contents of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class _TruncationIndex:
+    """The _ReadMeasures of every read of a sample, stored in a directory
+
+    The index of a sample is keyed by the digest of the input file and the
+    parameters the measures depend on, and holds one uint16 column per
+    measure. When an index is found, the measures are taken from it batch by
+    batch; otherwise they are added as they are computed and the index is
+    saved once the sample is complete. Indexes are not saved for reads
+    longer than a uint16 can describe.
+    """
+    def __init__(self, directory, input_path, phred_offset, min_quality,
+                 quality_window, trim_mode='consecutive'):
+        self.path = os.path.join(directory, '%s-%s-q%d-w%d-p%d.npz' % (
+            _digest(input_path), trim_mode, min_quality, quality_window,
+            phred_offset))
+        self.found = os.path.exists(self.path)
+        self._columns = None
+        self._offset = 0
+        self._parts = []
+
+        if self.found:
+            with np.load(self.path) as data:
+                self._columns = _ReadMeasures(
+                    *(data[name] for name in _ReadMeasures._fields))
+
+    def take(self, n):
+        """The measures of the next n reads of the sample"""
+        start, self._offset = self._offset, self._offset + n
+        if self._offset > len(self._columns.full_lengths):
+            raise ValueError('The truncation index %s holds fewer reads than '
+                             'its sample.' % self.path)
+        full_lengths, positions, n_ambiguous = (
+            column[start:self._offset].astype(np.int64)
+            for column in self._columns)
+        positions[positions == _NOT_TRUNCATED] = -1
+        return _ReadMeasures(full_lengths, positions, n_ambiguous)
+
+    def add(self, measures):
+        self._parts.append(measures)
+
+    def finish(self):
+        """Save a new index, or check that a found one was used up"""
+        if self.found:
+            if self._offset != len(self._columns.full_lengths):
+                raise ValueError('The truncation index %s holds more reads '
+                                 'than its sample.' % self.path)
+            return
+
+        columns = {name: np.concatenate([getattr(part, name)
+                                         for part in self._parts])
+                   if self._parts else np.empty(0, dtype=np.int64)
+                   for name in _ReadMeasures._fields}
+        # positions and ambiguous base counts are bounded by the length
+        full_lengths = columns['full_lengths']
+        if full_lengths.size and full_lengths.max() >= _NOT_TRUNCATED:
+            return
+        columns['positions'][columns['positions'] < 0] = _NOT_TRUNCATED
+
+        # write atomically so that concurrent runs never see a partial index
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(suffix='.npz', dir=directory)
+        with os.fdopen(fd, 'wb') as fh:
+            np.savez(fh, **{name: column.astype(np.uint16)
+                            for name, column in columns.items()})
+        os.replace(temp_path, self.path)
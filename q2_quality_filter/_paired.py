@@ -0,0 +1,184 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import concurrent.futures
+import contextlib
+import os
+import time
+
+import pandas as pd
+from q2_types.per_sample_sequences import (
+    SingleLanePerSamplePairedEndFastqDirFmt)
+
+from ._filter import (_add_counts, _all_filtered, _BatchResult,
+                      _default_params, _filter_params, _FilterPlan,
+                      _new_counts, _read_demux, _SampleReader,
+                      _SampleWriter, _sample_paths, _stats_frame,
+                      _write_manifest)
+from ._pipeline import _StageTimes, _WriteBehind
+
+
+def _read_paired_demux(demux):
+    """Returns the phred offset and (sample id, forward path, reverse path)
+    of each sample
+    """
+    phred_offset, files = _read_demux(demux, directions=True)
+
+    # samples keep the order in which their first file is encountered
+    paths = {}
+    for sample_id, path, direction in files:
+        paths.setdefault(sample_id, {})[direction] = path
+
+    samples = []
+    for sample_id, mates in paths.items():
+        for direction in ('forward', 'reverse'):
+            if direction not in mates:
+                raise ValueError('The %s reads of sample %s are missing.'
+                                 % (direction, sample_id))
+        samples.append((sample_id, mates['forward'], mates['reverse']))
+    return phred_offset, samples
+
+
+def _iter_paired_batches(forward, reverse):
+    """Pair up the batches of the forward and reverse reads of a sample
+
+    The batches of the two files hold different numbers of reads, so the
+    larger of two batches is split and its remainder is paired with the
+    next batch of the other file. Each pair of batches yielded holds the
+    same number of reads.
+    """
+    forward_batch = reverse_batch = None
+    while True:
+        if not forward_batch:
+            forward_batch = next(forward, None)
+        if not reverse_batch:
+            reverse_batch = next(reverse, None)
+        if forward_batch is None or reverse_batch is None:
+            if forward_batch or reverse_batch:
+                raise ValueError('The forward and reverse reads of a sample '
+                                 'hold different numbers of reads.')
+            return
+
+        n = min(len(forward_batch), len(reverse_batch))
+        if n:
+            yield forward_batch[:n], reverse_batch[:n]
+        forward_batch, reverse_batch = forward_batch[n:], reverse_batch[n:]
+
+
+def _pair_result(forward, reverse):
+    """Combine the _BatchResults of the mates of read pairs
+
+    A pair is kept if both of its mates are kept, and is attributed to the
+    first filter either mate fails. lengths are not combined.
+    """
+    too_short = forward.too_short | reverse.too_short
+    ambiguous = (forward.ambiguous | reverse.ambiguous) & ~too_short
+    too_many_errors = (forward.too_many_errors | reverse.too_many_errors) & \
+        ~too_short & ~ambiguous
+    return _BatchResult(None, forward.truncated | reverse.truncated,
+                        forward.poly_g | reverse.poly_g, too_short,
+                        ambiguous, too_many_errors,
+                        forward.kept & reverse.kept)
+
+
+def _filter_paired_sample(input_paths, output_paths, phred_offset, params,
+                          threads=1):
+    """Quality filter the read pairs of one sample
+
+    input_paths and output_paths hold the forward and reverse paths. The
+    two files are read, filtered and written in lockstep, each direction
+    being read and written by threads of its own while the reverse reads
+    of each batch are filtered in a thread alongside the forward reads.
+    Returns the stats of the pairs.
+    """
+    readers = [_SampleReader(path, phred_offset) for path in input_paths]
+    filtering = readers[0].batches.waiting
+    readers[1].batches.waiting = filtering
+    times = [reader.times for reader in readers] + [filtering]
+
+    start = time.perf_counter()
+    writers = []
+    for input_path, output_path in zip(input_paths, output_paths):
+        times.append(_StageTimes('write'))
+        writers.append(_WriteBehind(
+            _SampleWriter(output_path, params, threads, input_path),
+            times[-1], filtering))
+    plans = [_FilterPlan(params) for _ in input_paths]
+    counts = _new_counts(params)
+    try:
+        with contextlib.closing(readers[0]), \
+                contextlib.closing(readers[1]), \
+                concurrent.futures.ThreadPoolExecutor(1) as executor:
+            for batches in _iter_paired_batches(readers[0].batches,
+                                                readers[1].batches):
+                reverse = executor.submit(plans[1].filter, batches[1])
+                results = [plans[0].filter(batches[0]), reverse.result()]
+                pair = _pair_result(*results)
+                _add_counts(counts, pair)
+                for writer, batch, result in zip(writers, batches, results):
+                    writer.write(batch, result._replace(kept=pair.kept))
+    finally:
+        for writer in writers:
+            writer.join()
+    filtering.busy = time.perf_counter() - start - filtering.idle
+    for reader, writer in zip(readers, writers):
+        writer.close(input_size=reader.size)
+
+    print('%s: %s' % (', '.join(os.path.basename(path)
+                                for path in input_paths),
+                      '; '.join(str(stage) for stage in times)))
+    return counts
+
+
+def q_score_paired(demux: SingleLanePerSamplePairedEndFastqDirFmt,
+                   min_quality: int = _default_params['min_quality'],
+                   quality_window: int = _default_params['quality_window'],
+                   min_length_fraction:
+                   float = _default_params['min_length_fraction'],
+                   max_ambiguous: int = _default_params['max_ambiguous'],
+                   n_jobs: int = 1,
+                   compression_level:
+                   int = _default_params['compression_level'],
+                   trim_mode: str = _default_params['trim_mode'],
+                   max_expected_errors: float = None,
+                   max_expected_errors_per_base: float = None,
+                   poly_g_min_length: int = None,
+                   poly_g_max_mismatches: int = 1) \
+                        -> (SingleLanePerSamplePairedEndFastqDirFmt,
+                            pd.DataFrame):
+    params = _filter_params(locals())
+    result = SingleLanePerSamplePairedEndFastqDirFmt()
+    phred_offset, demux_samples = _read_paired_demux(demux)
+
+    sample_ids = [sample_id for sample_id, _, _ in demux_samples]
+    forward_paths = _sample_paths(result, sample_ids, read_number=1)
+    reverse_paths = _sample_paths(result, sample_ids, read_number=2)
+    args = [((forward, reverse), (str(forward_path), str(reverse_path)),
+             phred_offset, params)
+            for (_, forward, reverse), forward_path, reverse_path
+            in zip(demux_samples, forward_paths, reverse_paths)]
+
+    if n_jobs == 1:
+        sample_counts = [_filter_paired_sample(*sample_args)
+                         for sample_args in args]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as \
+                executor:
+            futures = [executor.submit(_filter_paired_sample, *sample_args)
+                       for sample_args in args]
+            sample_counts = [future.result() for future in futures]
+
+    if _all_filtered(sample_counts):
+        raise ValueError("All sequences from all samples were filtered out. "
+                         "The parameter choices may be too stringent for the "
+                         "data.")
+
+    _write_manifest(result, sample_ids, forward_paths, sample_counts,
+                    phred_offset, reverse_paths)
+
+    return result, _stats_frame(sample_ids, sample_counts)
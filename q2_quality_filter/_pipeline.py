@@ -0,0 +1,158 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import queue
+import threading
+import time
+
+
+# the number of items held between two stages of a pipeline
+_QUEUE_SIZE = 4
+
+_DONE = object()
+
+
+class _StageTimes:
+    """Time spent working (busy) and blocked on other stages (idle)"""
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.0
+        self.idle = 0.0
+
+    def __str__(self):
+        return '%s %.2fs busy, %.2fs idle' % (self.name, self.busy, self.idle)
+
+
+def _put(items, item, stop):
+    """Put item on a bounded queue unless stop is set while waiting"""
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+class _ReadAhead:
+    """Iterate over iterable in a background thread
+
+    The thread starts producing items on construction, and at most maxsize
+    items are produced ahead of the consumer. The time the producer spends
+    producing and blocked on a full queue is recorded in times, and the time
+    the consumer is blocked on an empty queue is added to waiting.idle.
+    Exceptions raised by the producer are re-raised in the consumer.
+    """
+    def __init__(self, iterable, times, waiting, maxsize=_QUEUE_SIZE):
+        self.waiting = waiting
+        self._items = queue.Queue(maxsize)
+        self._stop = threading.Event()
+        self._finished = False
+        self._thread = threading.Thread(target=self._produce,
+                                        args=(iterable, times), daemon=True)
+        self._thread.start()
+
+    def _produce(self, iterable, times):
+        iterator = iter(iterable)
+        try:
+            while not self._stop.is_set():
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                produced = time.perf_counter()
+                times.busy += produced - start
+                _put(self._items, (item, None), self._stop)
+                times.idle += time.perf_counter() - produced
+        except BaseException as error:
+            _put(self._items, (None, error), self._stop)
+        finally:
+            # release resources held by an abandoned generator in this thread
+            if hasattr(iterator, 'close'):
+                iterator.close()
+            _put(self._items, _DONE, self._stop)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+        start = time.perf_counter()
+        item = self._items.get()
+        self.waiting.idle += time.perf_counter() - start
+        if item is _DONE:
+            self.close()
+            raise StopIteration
+        item, error = item
+        if error is not None:
+            self.close()
+            raise error
+        return item
+
+    def close(self):
+        """Stop producing items and wait for the background thread"""
+        self._finished = True
+        self._stop.set()
+        self._thread.join()
+
+
+class _WriteBehind:
+    """Forward the write calls made on target to a background thread
+
+    At most maxsize calls are pending at once. The time the background
+    thread spends writing and waiting for calls is recorded in times, and
+    the time callers are blocked on a full queue is added to waiting.idle.
+    An exception raised by target is re-raised by the next call.
+    """
+    def __init__(self, target, times, waiting, maxsize=_QUEUE_SIZE):
+        self._target = target
+        self._times = times
+        self._waiting = waiting
+        self._calls = queue.Queue(maxsize)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            start = time.perf_counter()
+            args = self._calls.get()
+            received = time.perf_counter()
+            self._times.idle += received - start
+            if args is _DONE:
+                return
+            # after an error the remaining calls are discarded so that
+            # callers are never blocked
+            if self._error is None:
+                try:
+                    self._target.write(*args)
+                except BaseException as error:
+                    self._error = error
+            self._times.busy += time.perf_counter() - received
+
+    def _raise(self):
+        if self._error is not None:
+            raise self._error
+
+    def write(self, *args):
+        self._raise()
+        start = time.perf_counter()
+        self._calls.put(args)
+        self._waiting.idle += time.perf_counter() - start
+
+    def join(self):
+        """Wait for the pending calls to complete"""
+        if self._thread.is_alive():
+            self._calls.put(_DONE)
+            self._thread.join()
+        self._raise()
+
+    def close(self, *args, **kwargs):
+        self.join()
+        return self._target.close(*args, **kwargs)
@@ -0,0 +1,114 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import numpy as np
+import pandas as pd
+
+
+# the stages of filtering at which the scores of reads are counted
+_STAGES = ['before', 'after']
+
+
+def _score_counts(qual, mask):
+    """The number of times each score occurs at each position of the reads
+
+    Returns counts[position, score] over the entries of qual where mask is
+    set, found by a single bincount over the batch.
+    """
+    n_scores = int(qual.max()) + 1 if qual.size else 0
+    width = qual.shape[1]
+    # entries outside of the mask are counted as an extra score, which is
+    # cheaper than selecting the others and is dropped below
+    index = np.where(mask, qual, np.intp(n_scores))
+    index += np.arange(width) * (n_scores + 1)
+    counts = np.bincount(index.ravel(), minlength=width * (n_scores + 1))
+    return counts.reshape(width, n_scores + 1)[:, :n_scores]
+
+
+class _QualityProfile:
+    """The scores observed at each position of the reads of a sample
+
+    counts[stage, position, score] counts the reads holding score at
+    position, before filtering and among the kept reads following
+    truncation. Profiles are summed with +, which widens to the longest
+    reads and highest score of either, and 0 + profile is profile so that
+    profiles accumulate in stats as the counts of reads do.
+    """
+    def __init__(self, counts=None):
+        if counts is None:
+            counts = np.zeros((len(_STAGES), 0, 0), dtype=np.int64)
+        self.counts = counts
+
+    @classmethod
+    def from_batch(cls, batch, result):
+        """The profile of a batch and its _BatchResult"""
+        qual, mask = batch.qual, batch.qual_mask
+        kept = mask & result.kept[:, None] & \
+            (np.arange(qual.shape[1]) < result.lengths[:, None])
+        return cls(np.stack([_score_counts(qual, mask),
+                             _score_counts(qual, kept)]))
+
+    def __add__(self, other):
+        if isinstance(other, int) and other == 0:
+            return self
+        shape = np.maximum(self.counts.shape, other.counts.shape)
+        counts = np.zeros(shape, dtype=np.int64)
+        for profile in (self, other):
+            _, n_positions, n_scores = profile.counts.shape
+            counts[:, :n_positions, :n_scores] += profile.counts
+        return type(self)(counts)
+
+    __radd__ = __add__
+
+
+def _profile_counts(profiles):
+    """Stack the counts of profiles into one uint32 array
+
+    Returns counts[sample, stage, position, score], padded with zeros to the
+    longest reads and highest score of any profile.
+    """
+    total = sum(profiles, _QualityProfile())
+    counts = np.zeros((len(profiles),) + total.counts.shape, dtype=np.uint32)
+    for i, profile in enumerate(profiles):
+        _, n_positions, n_scores = profile.counts.shape
+        counts[i, :, :n_positions, :n_scores] = profile.counts
+    return counts
+
+
+def _write_profile(path, sample_ids, counts):
+    # written through a file object, as numpy appends .npz to other paths
+    with open(path, 'wb') as fh:
+        np.savez_compressed(fh, sample_ids=np.array(sample_ids, dtype=str),
+                            counts=counts)
+
+
+def _read_profile(path):
+    """Returns the sample ids and counts stored at path"""
+    with np.load(path) as data:
+        return data['sample_ids'].tolist(), data['counts']
+
+
+def _profile_to_df(sample_ids, counts):
+    """A row per sample, stage and position, with a column per score"""
+    n_samples, n_stages, n_positions, n_scores = counts.shape
+    index = pd.MultiIndex.from_product(
+        [sample_ids, _STAGES, range(n_positions)],
+        names=['sample-id', 'stage', 'position'])
+    df = pd.DataFrame(counts.reshape(-1, n_scores), index=index,
+                      columns=range(n_scores))
+    return df.reset_index(['stage', 'position'])
+
+
+def _df_to_profile(df):
+    """Inverse of _profile_to_df"""
+    sample_ids = df.index.unique().tolist()
+    scores = df.drop(columns=['stage', 'position'])
+    n_positions = int(df['position'].max()) + 1 if len(df) else 0
+    counts = scores.to_numpy(dtype=np.uint32).reshape(
+        len(sample_ids), len(_STAGES), n_positions, scores.shape[1])
+    return sample_ids, counts
@@ -0,0 +1,145 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import concurrent.futures
+import itertools
+
+import numpy as np
+import pandas as pd
+from q2_types.per_sample_sequences import (
+    SingleLanePerSampleSingleEndFastqDirFmt)
+
+from ._filter import (_default_params, _gather, _read_demux,
+                      _read_fastq_batches, _rounded_fractions,
+                      _stats_columns)
+
+
+_grid_columns = ['min-quality', 'quality-window', 'min-length-fraction',
+                 'max-ambiguous']
+
+
+def _sweep_batch(batch, min_quality, quality_window, min_length_fraction,
+                 max_ambiguous):
+    """Apply every combination of the filter parameters to a batch
+
+    Each parameter is a list of values, and the combinations are taken in
+    the order of itertools.product. Returns an array holding the number of
+    reads truncated, too short following truncation, exceeding the maximum
+    ambiguous bases and kept per combination. The run lengths of low scores
+    are derived once per min_quality and the ambiguous base counts once per
+    batch, so that each further combination costs a few comparisons per
+    read.
+    """
+    n_combinations = (len(min_quality) * len(quality_window) *
+                      len(min_length_fraction) * len(max_ambiguous))
+    counts = np.zeros((n_combinations, 4), dtype=np.int64)
+    if len(batch) == 0:
+        return counts
+
+    full_lengths = batch.lengths
+    qual, mask = batch.qual, batch.qual_mask
+    rows = np.arange(len(batch))
+
+    # the number of N base calls within the first i bases of each read
+    seqs, _ = _gather(batch.data, batch.line_starts[:, 1], full_lengths)
+    n_before = np.zeros((len(batch), qual.shape[1] + 1), dtype=np.int32)
+    np.cumsum((seqs == ord('N')) & mask, axis=1, out=n_before[:, 1:])
+
+    index = 0
+    for quality in min_quality:
+        below = (qual < quality) & mask
+        run_lengths = np.cumsum(below, axis=1, dtype=np.int32)
+        resets = np.where(below, 0, run_lengths)
+        np.maximum.accumulate(resets, axis=1, out=resets)
+        run_lengths -= resets
+        # the longest run of low scores seen up to each position
+        np.maximum.accumulate(run_lengths, axis=1, out=run_lengths)
+
+        for window in quality_window:
+            window = max(window, 0)
+            # the first position at which the run exceeds the window
+            first = np.count_nonzero(run_lengths <= window, axis=1)
+            truncated = first < qual.shape[1]
+            lengths = np.where(truncated,
+                               np.minimum(first - window, full_lengths),
+                               full_lengths)
+
+            fractions = np.zeros(len(batch))
+            fractions[truncated] = _rounded_fractions(
+                lengths[truncated], full_lengths[truncated])
+            n_ambiguous = n_before[rows, lengths]
+            n_truncated = np.count_nonzero(truncated)
+
+            for fraction in min_length_fraction:
+                too_short = truncated & (fractions <= fraction)
+                remaining = ~too_short
+                for maximum in max_ambiguous:
+                    ambiguous = remaining & (n_ambiguous > maximum)
+                    counts[index] = (
+                        n_truncated, np.count_nonzero(too_short),
+                        np.count_nonzero(ambiguous),
+                        np.count_nonzero(remaining & ~ambiguous))
+                    index += 1
+
+    return counts
+
+
+def _sweep_sample(input_path, phred_offset, grid):
+    """Sum the per combination counts of _sweep_batch over a sample
+
+    Returns the number of input reads and the summed counts.
+    """
+    n_reads = 0
+    counts = None
+    for batch in _read_fastq_batches(input_path, phred_offset):
+        n_reads += len(batch)
+        batch_counts = _sweep_batch(batch, *grid)
+        counts = batch_counts if counts is None else counts + batch_counts
+    if counts is None:
+        counts = _sweep_batch([], *grid)
+    return n_reads, counts
+
+
+def q_score_sweep(demux: SingleLanePerSampleSingleEndFastqDirFmt,
+                  min_quality: list = [_default_params['min_quality']],
+                  quality_window: list = [_default_params['quality_window']],
+                  min_length_fraction:
+                  list = [_default_params['min_length_fraction']],
+                  max_ambiguous: list = [_default_params['max_ambiguous']],
+                  n_jobs: int = 1) -> pd.DataFrame:
+    phred_offset, demux_samples = _read_demux(demux)
+
+    grid = (list(min_quality), list(quality_window),
+            list(min_length_fraction), list(max_ambiguous))
+
+    sample_ids = [sample_id for sample_id, _ in demux_samples]
+    paths = [path for _, path in demux_samples]
+
+    if n_jobs == 1:
+        results = [_sweep_sample(path, phred_offset, grid) for path in paths]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as \
+                executor:
+            results = list(executor.map(_sweep_sample, paths,
+                                        [phred_offset] * len(paths),
+                                        [grid] * len(paths)))
+
+    rows = []
+    for sample_id, (n_reads, counts) in zip(sample_ids, results):
+        for combination, (truncated, too_short, ambiguous, kept) in zip(
+                itertools.product(*grid), counts.tolist()):
+            rows.append((sample_id, *combination, n_reads, kept, truncated,
+                         too_short, ambiguous))
+
+    stats = pd.DataFrame(rows, columns=['sample-id'] + _grid_columns +
+                         _stats_columns)
+    # samples are sorted while the combinations keep the order of the grid
+    stats.sort_values('sample-id', kind='stable', inplace=True)
+    stats.set_index('sample-id', inplace=True)
+
+    return stats
@@ -10,7 +10,10 @@ import pandas as pd
 import qiime2
 
 from .plugin_setup import plugin
-from ._format import QualityFilterStatsFmt
+from ._format import (QualityFilterStatsFmt, QualityFilterSweepStatsFmt,
+                      QualityFilterProfileFmt)
+from ._profile import (_df_to_profile, _profile_to_df, _read_profile,
+                       _write_profile)
 
 
 @plugin.register_transformer
@@ -27,6 +30,11 @@ _stats_column_dtypes = {
     'reads-truncated': int,
     'reads-too-short-after-truncation': int,
     'reads-exceeding-maximum-ambiguous-bases': int,
+    'reads-poly-g-trimmed': int,
+    'reads-exceeding-maximum-expected-errors': int,
+    'reads-not-subsampled': int,
+    'processing': str,
+    'compression-backend': str,
 }
 
 
@@ -45,3 +53,40 @@ def _2(ff: QualityFilterStatsFmt) -> pd.DataFrame:
 @plugin.register_transformer
 def _3(ff: QualityFilterStatsFmt) -> qiime2.Metadata:
     return qiime2.Metadata(_stats_to_df(ff))
+
+
+@plugin.register_transformer
+def _4(data: pd.DataFrame) -> QualityFilterSweepStatsFmt:
+    ff = QualityFilterSweepStatsFmt()
+    data.to_csv(str(ff))
+    return ff
+
+
+_sweep_column_dtypes = {
+    'min-quality': int,
+    'quality-window': int,
+    'min-length-fraction': float,
+    'max-ambiguous': int,
+    **_stats_column_dtypes,
+}
+
+
+@plugin.register_transformer
+def _5(ff: QualityFilterSweepStatsFmt) -> pd.DataFrame:
+    # a sample-id occurs once per combination of the parameters
+    df = pd.read_csv(str(ff), dtype=_sweep_column_dtypes)
+    df.set_index('sample-id', inplace=True)
+    return df
+
+
+@plugin.register_transformer
+def _6(ff: QualityFilterProfileFmt) -> pd.DataFrame:
+    # a row per sample, stage and position, with a column per PHRED score
+    return _profile_to_df(*_read_profile(str(ff)))
+
+
+@plugin.register_transformer
+def _7(data: pd.DataFrame) -> QualityFilterProfileFmt:
+    ff = QualityFilterProfileFmt()
+    _write_profile(str(ff), *_df_to_profile(data))
+    return ff
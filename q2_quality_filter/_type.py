@@ -9,3 +9,5 @@
 from qiime2.plugin import SemanticType
 
 QualityFilterStats = SemanticType('QualityFilterStats')
+QualityFilterSweepStats = SemanticType('QualityFilterSweepStats')
+QualityFilterProfile = SemanticType('QualityFilterProfile')
@@ -15,9 +15,15 @@ from q2_types.per_sample_sequences import (
     JoinedSequencesWithQuality)
 
 import q2_quality_filter
-from q2_quality_filter._type import QualityFilterStats
+from q2_quality_filter._type import (QualityFilterStats,
+                                     QualityFilterSweepStats,
+                                     QualityFilterProfile)
 from q2_quality_filter._format import (QualityFilterStatsFmt,
-                                       QualityFilterStatsDirFmt)
+                                       QualityFilterStatsDirFmt,
+                                       QualityFilterSweepStatsFmt,
+                                       QualityFilterSweepStatsDirFmt,
+                                       QualityFilterProfileFmt,
+                                       QualityFilterProfileDirFmt)
 import q2_quality_filter._examples as ex
 
 citations = qiime2.plugin.Citations.load(
@@ -35,12 +41,22 @@ plugin = qiime2.plugin.Plugin(
     citations=citations
 )
 
-plugin.register_formats(QualityFilterStatsFmt, QualityFilterStatsDirFmt)
+plugin.register_formats(QualityFilterStatsFmt, QualityFilterStatsDirFmt,
+                        QualityFilterSweepStatsFmt,
+                        QualityFilterSweepStatsDirFmt,
+                        QualityFilterProfileFmt, QualityFilterProfileDirFmt)
 
-plugin.register_semantic_types(QualityFilterStats)
+plugin.register_semantic_types(QualityFilterStats, QualityFilterSweepStats,
+                               QualityFilterProfile)
 plugin.register_semantic_type_to_format(
     QualityFilterStats,
     artifact_format=QualityFilterStatsDirFmt)
+plugin.register_semantic_type_to_format(
+    QualityFilterSweepStats,
+    artifact_format=QualityFilterSweepStatsDirFmt)
+plugin.register_semantic_type_to_format(
+    QualityFilterProfile,
+    artifact_format=QualityFilterProfileDirFmt)
 
 InputMap, OutputMap = qiime2.plugin.TypeMap({
     SampleData[SequencesWithQuality | PairedEndSequencesWithQuality]:
@@ -54,7 +70,32 @@ _q_score_parameters = {
     'min_quality': qiime2.plugin.Int,
     'quality_window': qiime2.plugin.Int,
     'min_length_fraction': qiime2.plugin.Float,
-    'max_ambiguous': qiime2.plugin.Int
+    'max_ambiguous': qiime2.plugin.Int,
+    'n_jobs': qiime2.plugin.Int % qiime2.plugin.Range(1, None),
+    'compression_level': qiime2.plugin.Int % qiime2.plugin.Range(
+        1, 9, inclusive_end=True),
+    'prefetch': qiime2.plugin.Int % qiime2.plugin.Range(0, None),
+    'truncation_index': qiime2.plugin.Str,
+    'cache_dir': qiime2.plugin.Str,
+    'cache_max_size': qiime2.plugin.Int % qiime2.plugin.Range(1, None),
+    'checkpoint_dir': qiime2.plugin.Str,
+    'trim_mode': qiime2.plugin.Str % qiime2.plugin.Choices(
+        'consecutive', 'sliding-window', 'mott'),
+    'max_expected_errors': qiime2.plugin.Float % qiime2.plugin.Range(
+        0, None),
+    'max_expected_errors_per_base': qiime2.plugin.Float % qiime2.plugin.Range(
+        0, None),
+    'poly_g_min_length': qiime2.plugin.Int % qiime2.plugin.Range(1, None),
+    'poly_g_max_mismatches': qiime2.plugin.Int % qiime2.plugin.Range(0, None),
+    'min_retention': qiime2.plugin.Float % qiime2.plugin.Range(
+        0, 1, inclusive_end=True),
+    'retention_sample_size': qiime2.plugin.Int % qiime2.plugin.Range(1, None),
+    'retention_confidence': qiime2.plugin.Float % qiime2.plugin.Range(
+        0.5, 1),
+    'max_reads_per_sample': qiime2.plugin.Int % qiime2.plugin.Range(1, None),
+    'subsample_fraction': qiime2.plugin.Float % qiime2.plugin.Range(
+        0, 1, inclusive_start=False, inclusive_end=True),
+    'subsample_seed': qiime2.plugin.Int
 }
 
 _q_score_input_descriptions = {
@@ -74,7 +115,110 @@ _q_score_parameter_descriptions = {
                            'as a fraction of the input sequence length.',
     'max_ambiguous': 'The maximum number of ambiguous (i.e., N) base '
                      'calls. This is applied after trimming sequences '
-                     'based on `min_length_fraction`.'
+                     'based on `min_length_fraction`.',
+    'n_jobs': 'The number of processes to use. Samples are distributed '
+              'across the processes and filtered independently; large '
+              'samples are additionally split into chunks which are '
+              'filtered in parallel.',
+    'compression_level': 'The gzip compression level of the filtered '
+                         'sequences, from 1 (fastest) to 9 (smallest). '
+                         'When python-isal is installed, it is used for '
+                         'compression and decompression and this level is '
+                         'mapped onto its levels 0 to 3.',
+    'prefetch': 'The number of samples to open and decompress in the '
+                'background while the current sample is filtered. This '
+                'hides the cost of opening many small files at the expense '
+                'of memory for the data read ahead, and only applies when '
+                '`n_jobs` is 1.',
+    'truncation_index': 'A directory in which to keep the truncation '
+                        'position, length and number of ambiguous bases of '
+                        'every read, per sample, `min_quality` and '
+                        '`quality_window`. When an index of a sample is '
+                        'found, the quality scores of its reads are not '
+                        'examined, so re-runs changing only '
+                        '`min_length_fraction` or `max_ambiguous` are '
+                        'faster. Samples are not split into chunks when '
+                        'this is provided.',
+    'cache_dir': 'A directory in which to cache the filtered reads and '
+                 'statistics of each sample. Samples whose input and '
+                 'parameters are unchanged since they were cached are taken '
+                 'from the cache rather than filtered again. Use the '
+                 '`q2-quality-filter-cache` command to inspect or prune the '
+                 'cache.',
+    'cache_max_size': 'The size in megabytes the cache is allowed to reach '
+                      'before the least recently used samples are evicted.',
+    'checkpoint_dir': 'A directory in which to record each sample as it '
+                      'completes. If the run is interrupted, running it '
+                      'again with the same inputs, parameters and '
+                      '`checkpoint_dir` resumes from the recorded samples. '
+                      'The files recorded are removed once the run '
+                      'completes, as is the directory if it is then '
+                      'empty.',
+    'trim_mode': 'The rule deciding where a read is truncated. With '
+                 '"consecutive", a read is truncated where more than '
+                 '`quality_window` consecutive PHRED scores are below '
+                 '`min_quality`. With "sliding-window", a read is truncated '
+                 'at the start of the first window of `quality_window` '
+                 'bases whose mean PHRED score is below `min_quality`, as '
+                 'by the SLIDINGWINDOW step of Trimmomatic. With "mott", '
+                 'the 3\' end of a read is trimmed as by BWA: the read is '
+                 'cut where the sum of `min_quality` minus the PHRED score, '
+                 'taken from the 3\' end, is greatest, so good sequence '
+                 'following a poor stretch is kept. `quality_window` is '
+                 'not used in this mode.',
+    'max_expected_errors': 'The maximum number of expected errors, the sum '
+                           'of the error probabilities implied by the PHRED '
+                           'scores, of a read following truncation. This is '
+                           'applied after `max_ambiguous`. If not provided, '
+                           'reads are not filtered by expected errors.',
+    'max_expected_errors_per_base': 'The maximum number of expected errors '
+                                    'of a read following truncation divided '
+                                    'by its length. This is applied along '
+                                    'with `max_expected_errors`.',
+    'poly_g_min_length': 'The minimum length of a trailing run of G base '
+                         'calls to trim from a read. Two-colour chemistry '
+                         '(e.g. NovaSeq, NextSeq) calls G with high quality '
+                         'where there is no signal. Trimming is applied '
+                         'after truncation, and trimmed reads are subject '
+                         'to `min_length_fraction`. If not provided, poly-G '
+                         'tails are not trimmed.',
+    'poly_g_max_mismatches': 'The number of base calls other than G '
+                             'tolerated within a poly-G tail.',
+    'min_retention': 'The fraction of reads a sample is expected to retain. '
+                     'Once `retention_sample_size` reads of a sample are '
+                     'filtered, a sample whose retention rate is below this '
+                     'with confidence `retention_confidence` is not '
+                     'processed further and none of its reads are retained. '
+                     'The statistics of such a sample describe the reads '
+                     'filtered and are marked "estimated" in the '
+                     '"processing" column. If not provided, every read of '
+                     'every sample is filtered. Samples are not split into '
+                     'chunks when this is provided.',
+    'retention_sample_size': 'The number of reads of a sample from which '
+                             'its retention rate is estimated.',
+    'retention_confidence': 'The confidence with which the retention rate '
+                            'must be below `min_retention` for a sample to '
+                            'be rejected, given by the upper Wilson score '
+                            'bound of the rate.',
+    'max_reads_per_sample': 'The number of reads retained per sample, '
+                            'taking the first reads passing the filter. A '
+                            'sample is not read further once it reaches this '
+                            'number, and its statistics are then marked '
+                            '"capped" in the "processing" column and count '
+                            'only the reads which were read. If not '
+                            'provided, every read passing the filter is '
+                            'retained. Samples are not split into chunks '
+                            'when this is provided.',
+    'subsample_fraction': 'The fraction of reads of each sample which are '
+                          'filtered, each read being drawn independently '
+                          'with this probability. The reads not drawn are '
+                          'counted in the "reads-not-subsampled" column. If '
+                          'not provided, every read is filtered. Samples are '
+                          'not split into chunks when this is provided.',
+    'subsample_seed': 'The seed of the random draws of '
+                      '`subsample_fraction`. Each sample is drawn from a '
+                      'generator with this seed, so that its subsample does '
+                      'not depend on the other samples.'
 }
 
 _q_score_output_descriptions = {
@@ -102,4 +246,194 @@ plugin.methods.register_function(
     },
 )
 
+_q_score_with_profile_parameters = {
+    name: _q_score_parameters[name]
+    for name in ['min_quality', 'quality_window', 'min_length_fraction',
+                 'max_ambiguous', 'n_jobs', 'compression_level', 'prefetch',
+                 'trim_mode', 'max_expected_errors',
+                 'max_expected_errors_per_base', 'poly_g_min_length',
+                 'poly_g_max_mismatches']}
+
+plugin.methods.register_function(
+    function=q2_quality_filter.q_score_with_profile,
+    inputs={'demux': InputMap},
+    parameters=_q_score_with_profile_parameters,
+    outputs=[
+        ('filtered_sequences', OutputMap),
+        ('filter_stats', QualityFilterStats),
+        ('quality_profile', QualityFilterProfile)
+    ],
+    input_descriptions=_q_score_input_descriptions,
+    parameter_descriptions={
+        name: _q_score_parameter_descriptions[name]
+        for name in _q_score_with_profile_parameters},
+    output_descriptions={
+        **_q_score_output_descriptions,
+        'quality_profile': 'The number of reads of each sample holding each '
+                           'PHRED score at each position, before filtering '
+                           'and among the retained reads following '
+                           'truncation. The profile of all samples is the '
+                           'sum of these.'
+    },
+    name='Quality filter and profile the quality of the reads.',
+    description=('This method filters sequences as `q_score` does, counting '
+                 'the PHRED scores at each position of the reads before and '
+                 'after filtering while they are read, so that the quality '
+                 'profile does not require a further pass over the data.'),
+)
+
+_q_score_stats_parameters = {
+    name: _q_score_parameters[name]
+    for name in ['min_quality', 'quality_window', 'min_length_fraction',
+                 'max_ambiguous', 'n_jobs', 'prefetch', 'truncation_index',
+                 'trim_mode', 'max_expected_errors',
+                 'max_expected_errors_per_base', 'poly_g_min_length',
+                 'poly_g_max_mismatches', 'min_retention',
+                 'retention_sample_size', 'retention_confidence',
+                 'max_reads_per_sample', 'subsample_fraction',
+                 'subsample_seed']}
+
+plugin.methods.register_function(
+    function=q2_quality_filter.q_score_stats,
+    inputs={'demux': SampleData[SequencesWithQuality |
+                                PairedEndSequencesWithQuality |
+                                JoinedSequencesWithQuality]},
+    parameters=_q_score_stats_parameters,
+    outputs=[('filter_stats', QualityFilterStats)],
+    input_descriptions=_q_score_input_descriptions,
+    parameter_descriptions={
+        name: _q_score_parameter_descriptions[name]
+        for name in _q_score_stats_parameters},
+    output_descriptions={
+        'filter_stats': _q_score_output_descriptions['filter_stats']
+    },
+    name='Report the statistics of quality filtering without its output.',
+    description=('This method filters sequences as `q_score` does and '
+                 'reports the same summary statistics, without writing or '
+                 'compressing the retained sequences. Unlike `q_score`, it '
+                 'does not fail if every sequence is filtered out.'),
+)
+
+_q_score_multi_parameters = {
+    'min_quality': qiime2.plugin.List[qiime2.plugin.Int],
+    'quality_window': qiime2.plugin.List[qiime2.plugin.Int],
+    'min_length_fraction': qiime2.plugin.List[qiime2.plugin.Float],
+    'max_ambiguous': qiime2.plugin.List[qiime2.plugin.Int],
+    'n_jobs': _q_score_parameters['n_jobs'],
+    'compression_level': _q_score_parameters['compression_level']
+}
+
+_multi_description = (
+    ' The i-th values of the parameters form the i-th parameter set; a '
+    'parameter given a single value uses it in every set.')
+
+plugin.methods.register_function(
+    function=q2_quality_filter.q_score_multi,
+    inputs={'demux': SampleData[SequencesWithQuality |
+                                PairedEndSequencesWithQuality]},
+    parameters=_q_score_multi_parameters,
+    outputs=[
+        ('filtered_sequences',
+         qiime2.plugin.Collection[SampleData[SequencesWithQuality]]),
+        ('filter_stats', qiime2.plugin.Collection[QualityFilterStats])
+    ],
+    input_descriptions=_q_score_input_descriptions,
+    parameter_descriptions={
+        'min_quality': _q_score_parameter_descriptions['min_quality'] +
+        _multi_description,
+        'quality_window': _q_score_parameter_descriptions['quality_window'] +
+        _multi_description,
+        'min_length_fraction':
+            _q_score_parameter_descriptions['min_length_fraction'] +
+            _multi_description,
+        'max_ambiguous': _q_score_parameter_descriptions['max_ambiguous'] +
+        _multi_description,
+        'n_jobs': 'The number of processes to use. Samples are distributed '
+                  'across the processes.',
+        'compression_level':
+            _q_score_parameter_descriptions['compression_level']
+    },
+    output_descriptions={
+        'filtered_sequences': 'The resulting quality-filtered sequences of '
+                              'each parameter set, keyed by the parameter '
+                              'values.',
+        'filter_stats': 'Summary statistics of the filtering process of '
+                        'each parameter set, keyed by the parameter values.'
+    },
+    name='Quality filter with several parameter sets at once.',
+    description=('This method applies `q_score` with each of several '
+                 'parameter sets, reading each sample once to produce the '
+                 'filtered sequences and summary statistics of every set.'),
+)
+
+_q_score_paired_parameters = {
+    name: _q_score_parameters[name]
+    for name in ['min_quality', 'quality_window', 'min_length_fraction',
+                 'max_ambiguous', 'n_jobs', 'compression_level', 'trim_mode',
+                 'max_expected_errors', 'max_expected_errors_per_base',
+                 'poly_g_min_length', 'poly_g_max_mismatches']}
+
+plugin.methods.register_function(
+    function=q2_quality_filter.q_score_paired,
+    inputs={'demux': SampleData[PairedEndSequencesWithQuality]},
+    parameters=_q_score_paired_parameters,
+    outputs=[
+        ('filtered_sequences', SampleData[PairedEndSequencesWithQuality]),
+        ('filter_stats', QualityFilterStats)
+    ],
+    input_descriptions=_q_score_input_descriptions,
+    parameter_descriptions={
+        name: _q_score_parameter_descriptions[name]
+        for name in _q_score_paired_parameters},
+    output_descriptions={
+        'filtered_sequences': 'The resulting quality-filtered read pairs.',
+        'filter_stats': 'Summary statistics of the filtering process, '
+                        'counting read pairs. A pair is attributed to the '
+                        'first filter either of its reads fails.'
+    },
+    name='Quality filter paired-end reads based on sequence quality scores.',
+    description=('This method filters the forward and reverse reads of each '
+                 'pair as `q_score` filters single reads, keeping a pair '
+                 'only if both of its reads are kept so that the mates '
+                 'remain in step.'),
+)
+
+plugin.methods.register_function(
+    function=q2_quality_filter.q_score_sweep,
+    inputs={'demux': SampleData[SequencesWithQuality |
+                                PairedEndSequencesWithQuality |
+                                JoinedSequencesWithQuality]},
+    parameters={
+        'min_quality': qiime2.plugin.List[qiime2.plugin.Int],
+        'quality_window': qiime2.plugin.List[qiime2.plugin.Int],
+        'min_length_fraction': qiime2.plugin.List[qiime2.plugin.Float],
+        'max_ambiguous': qiime2.plugin.List[qiime2.plugin.Int],
+        'n_jobs': _q_score_parameters['n_jobs']
+    },
+    outputs=[('sweep_stats', QualityFilterSweepStats)],
+    input_descriptions=_q_score_input_descriptions,
+    parameter_descriptions={
+        'min_quality': 'The values of `min_quality` of `q_score` to '
+                       'evaluate.',
+        'quality_window': 'The values of `quality_window` of `q_score` to '
+                          'evaluate.',
+        'min_length_fraction': 'The values of `min_length_fraction` of '
+                               '`q_score` to evaluate.',
+        'max_ambiguous': 'The values of `max_ambiguous` of `q_score` to '
+                         'evaluate.',
+        'n_jobs': 'The number of processes to use. Samples are distributed '
+                  'across the processes.'
+    },
+    output_descriptions={
+        'sweep_stats': 'The summary statistics `q_score` would report for '
+                       'each sample under each combination of the '
+                       'parameters.'
+    },
+    name='Evaluate a grid of quality filter parameters.',
+    description=('This method reads each sample once and evaluates every '
+                 'combination of the given parameter values against it, '
+                 'reporting the number of reads `q_score` would retain, '
+                 'truncate and discard. No sequences are written.'),
+)
+
 importlib.import_module('q2_quality_filter._transformer')
@@ -7,8 +7,17 @@
 # ----------------------------------------------------------------------------
 
 import unittest
+import contextlib
 import gzip
+import inspect
+import io
+import itertools
 import os
+import struct
+import sys
+import tempfile
+import zlib
+from unittest import mock
 
 import pandas as pd
 import pandas.testing as pdt
@@ -16,6 +25,7 @@ import qiime2
 from qiime2.sdk import Artifact
 import numpy as np
 import numpy.testing as npt
+from qiime2.plugin import ValidationError
 from qiime2.plugin.testing import TestPluginBase
 from qiime2.util import redirected_stdio
 from q2_types.per_sample_sequences import (
@@ -23,12 +33,79 @@ from q2_types.per_sample_sequences import (
     SingleLanePerSampleSingleEndFastqDirFmt,
 )
 
+from q2_quality_filter._cache import (_Checkpoint, _ResultCache, _sample_key,
+                                      main as _cache_main)
+from q2_quality_filter._compression import (
+    _BACKEND,
+    _bgzf_blocks,
+    _bgzf_chunks,
+    _gzip_backend,
+    _load_backend,
+    _ParallelGzipWriter,
+)
 from q2_quality_filter._filter import (
+    _count_ambiguous,
+    _count_ambiguous_spans,
+    _expected_errors,
+    _filter_batch,
+    _filter_batches,
+    _filter_param_names,
+    _filter_params,
+    _filter_prefetched,
+    _filter_sample,
+    _filter_sample_multi,
+    _filter_samples,
+    _filter_samples_stored,
+    _FilterPlan,
+    _first_bad_mean,
+    _first_bad_window,
+    _format_records,
+    _gather,
+    _iter_fastq_batches,
+    _measure_batch,
+    _mott_position,
+    _poly_g_start,
+    _read_fastq_batches,
+    _read_fastq_chunk,
     _read_fastq_seqs,
+    _retention_upper_bound,
     _runs_of_ones,
+    _SampleWriter,
     _truncate,
+    q_score,
+    q_score_stats,
+    q_score_with_profile,
+)
+from q2_quality_filter._format import (QualityFilterProfileFmt,
+                                       QualityFilterStatsFmt)
+from q2_quality_filter._index import _TruncationIndex
+from q2_quality_filter._paired import (
+    _filter_paired_sample,
+    _iter_paired_batches,
+    _read_paired_demux,
+    q_score_paired,
+)
+from q2_quality_filter._profile import _QualityProfile
+from q2_quality_filter._pipeline import (
+    _ReadAhead,
+    _StageTimes,
+    _WriteBehind,
 )
-from q2_quality_filter._format import QualityFilterStatsFmt
+from q2_quality_filter._sweep import _sweep_batch
+
+
+def _bgzf_compress(data, block_size):
+    """Compress data as BGZF using blocks of block_size bytes"""
+    members = []
+    for start in range(0, len(data), block_size):
+        block = data[start:start + block_size]
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        body = compressor.compress(block) + compressor.flush()
+        header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6,
+                             66, 67, 2, len(body) + 25)
+        members.append(header + body +
+                       struct.pack('<2I', zlib.crc32(block), len(block)))
+    return b''.join(members)
 
 
 class FilterTests(TestPluginBase):
@@ -44,6 +121,350 @@ class FilterTests(TestPluginBase):
             self.assertEqual(o[:4], e[:4])
             npt.assert_equal(o[4], e[4])
 
+    def test_read_fastq_batches(self):
+        obs = list(_read_fastq_batches(
+            self.get_data_path('simple.fastq.gz'), 33))
+        self.assertEqual(len(obs), 1)
+
+        batch = obs[0]
+        self.assertEqual(len(batch), 2)
+        npt.assert_equal(batch.lengths, np.array([4, 4]))
+        npt.assert_equal(batch.qual, np.array([[40, 40, 40, 40],
+                                               [32, 33, 34, 35]]))
+        self.assertEqual(batch.line(1, 0), b'@bar')
+        self.assertEqual(batch.buffer[batch.record_starts[1]:
+                                      batch.record_ends[1]],
+                         b'@bar\nTGCA\n+\nABCD\n')
+
+    def test_iter_fastq_batches_split_records(self):
+        data = (b'@a\nACGT\n+\nIIII\n'
+                b'@b\r\nAC \r\n+\r\nI#\r\n'
+                b'@c\nACGTAC\n+\n#IIIII')
+        # a block size smaller than a record forces records to span blocks
+        obs = list(_iter_fastq_batches(io.BytesIO(data), 33, block_size=7))
+        self.assertEqual(sum(len(b) for b in obs), 3)
+
+        records = [b.record(i) for b in obs for i in range(len(b))]
+        exp = [(b'@a', b'ACGT', b'+', b'IIII', np.array([40, 40, 40, 40])),
+               (b'@b', b'AC', b'+', b'I#', np.array([40, 2])),
+               (b'@c', b'ACGTAC', b'+', b'#IIIII',
+                np.array([2, 40, 40, 40, 40, 40]))]
+        for o, e in zip(records, exp):
+            self.assertEqual(o[:4], e[:4])
+            npt.assert_equal(o[4], e[4])
+
+        sliced = obs[-1][1:]
+        self.assertEqual(len(sliced), len(obs[-1]) - 1)
+
+    def test_gather(self):
+        data = np.frombuffer(b'ABCDEFGH', dtype=np.uint8)
+        for starts, lengths, exp in [
+                # ranges of a common length, the last ending with data
+                ([0, 5], [3, 3], [b'ABC', b'FGH']),
+                # ragged ranges are zero padded, and rows of the last
+                # extend past the end of data
+                ([1, 6], [4, 2], [b'BCDE', b'GH\0\0']),
+                ([0, 7], [0, 0], [b'', b''])]:
+            matrix, mask = _gather(data, np.array(starts), np.array(lengths))
+            self.assertEqual([row.tobytes() for row in matrix], exp)
+            npt.assert_equal(mask.sum(axis=1), lengths)
+
+        matrix, mask = _gather(data, np.zeros(0, dtype=np.int64),
+                               np.zeros(0, dtype=np.int64))
+        self.assertEqual(matrix.shape, (0, 0))
+
+    def test_iter_fastq_batches_incomplete_record(self):
+        data = b'@a\nACGT\n+\nIIII\n@b\nAC\n'
+        with self.assertRaisesRegex(ValueError, 'incomplete record'):
+            list(_iter_fastq_batches(io.BytesIO(data), 33))
+
+    def test_bgzf_chunks(self):
+        data = gzip.open(self.get_data_path('simple.fastq.gz'), 'rb').read()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'simple.fastq.gz')
+            with open(path, 'wb') as fh:
+                fh.write(_bgzf_compress(data, 5))
+
+            blocks = _bgzf_blocks(path)
+            self.assertEqual([size for _, size in blocks],
+                             [5, 5, 5, 5, 5, 5, 4])
+            self.assertIsNone(
+                _bgzf_chunks(self.get_data_path('simple.fastq.gz'), 10))
+
+            # every record is parsed by exactly one chunk
+            for chunk_size in (1, 7, 16, 40):
+                chunks = _bgzf_chunks(path, chunk_size)
+                self.assertEqual(sum(chunk.size for chunk in chunks), 34)
+                obs = [batch.record(i)[:4]
+                       for chunk in chunks
+                       for batch in _read_fastq_chunk(chunk, 33)
+                       for i in range(len(batch))]
+                self.assertEqual(obs, [(b'@foo', b'ATGC', b'+', b'IIII'),
+                                       (b'@bar', b'TGCA', b'+', b'ABCD')])
+
+    def test_filter_samples_chunked(self):
+        params = {'min_quality': 33, 'quality_window': 1,
+                  'min_length_fraction': 0.25, 'max_ambiguous': 0,
+                  'compression_level': 9}
+        data = gzip.open(self.get_data_path('simple.fastq.gz'), 'rb').read()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            bgzf_path = os.path.join(temp_dir, 'bgzf.fastq.gz')
+            with open(bgzf_path, 'wb') as fh:
+                fh.write(_bgzf_compress(data * 50, 64))
+
+            # a budget smaller than a chunk holds one chunk at a time
+            for input_path, chunk_budget in [
+                    (bgzf_path, 1024),
+                    (self.get_data_path('simple.fastq.gz'), 1024),
+                    (self.get_data_path('simple.fastq.gz'), 1)]:
+                exp_path = os.path.join(temp_dir, 'exp.fastq.gz')
+                obs_path = os.path.join(temp_dir, 'obs.fastq.gz')
+                exp = _filter_sample(input_path, exp_path, 33, params)
+                obs, = _filter_samples([(input_path, obs_path)], 33, params,
+                                       n_jobs=2, chunk_size=30,
+                                       chunk_budget=chunk_budget)
+                self.assertEqual(obs, exp)
+                self.assertEqual(gzip.open(obs_path, 'rb').read(),
+                                 gzip.open(exp_path, 'rb').read())
+
+    def test_filter_samples_stats_only(self):
+        params = {'min_quality': 33, 'quality_window': 1,
+                  'min_length_fraction': 0.25, 'max_ambiguous': 0}
+        input_path = self.get_data_path('simple.fastq.gz')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout):
+                exp = _filter_sample(input_path,
+                                     os.path.join(temp_dir, 'exp.fastq.gz'),
+                                     33, dict(params, compression_level=9))
+            # the busy and idle time of each stage is printed
+            self.assertRegex(stdout.getvalue(),
+                             r'^simple\.fastq\.gz: read .*s busy, .*s idle; '
+                             r'filter .*; write .*\n$')
+            for n_jobs in (1, 2):
+                obs, = _filter_samples([(input_path, None)], 33, params,
+                                       n_jobs=n_jobs, chunk_size=30)
+                self.assertEqual(obs, exp)
+            self.assertEqual(os.listdir(temp_dir), ['exp.fastq.gz'])
+
+    def test_retention_upper_bound(self):
+        self.assertAlmostEqual(_retention_upper_bound(0, 100, 0.975),
+                               0.036993, places=6)
+        self.assertAlmostEqual(_retention_upper_bound(50, 100, 0.975),
+                               0.596168, places=6)
+        self.assertLess(_retention_upper_bound(50, 10000, 0.99),
+                        _retention_upper_bound(5, 1000, 0.99))
+        self.assertEqual(_retention_upper_bound(0, 0, 0.99), 1.0)
+
+    def test_filter_sample_retention_estimate(self):
+        params = {'min_quality': 20, 'quality_window': 1,
+                  'min_length_fraction': 0.5, 'max_ambiguous': 0,
+                  'compression_level': 9, 'min_retention': 0.5,
+                  'retention_sample_size': 100}
+        good = b'@a\nACGTACGT\n+\nIIIIIIII\n'
+        bad = b'@b\nACGTACGT\n+\nII######\n'
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_path = os.path.join(temp_dir, 'in.fastq.gz')
+            output_path = os.path.join(temp_dir, 'out.fastq.gz')
+            # enough reads to span several batches
+            for reads, processing in [(good + bad, 'full'),
+                                      (good + bad * 9, 'estimated')]:
+                with gzip.open(input_path, 'wb') as fh:
+                    fh.write(reads * 20000)
+
+                counts, = _filter_sample_multi(
+                    input_path, [output_path], 33, [params])
+                self.assertEqual(counts['processing'], processing)
+                if processing == 'full':
+                    self.assertEqual(counts['total-input-reads'], 40000)
+                    self.assertEqual(counts['total-retained-reads'], 20000)
+                    # the batch split at the estimate is written whole
+                    self.assertEqual(gzip.open(output_path, 'rb').read(),
+                                     good * 20000)
+                    os.remove(output_path)
+                else:
+                    # filtering stopped at retention_sample_size reads,
+                    # within the first batch
+                    self.assertEqual(counts['total-input-reads'], 100)
+                    self.assertEqual(counts['total-retained-reads'], 0)
+                    self.assertFalse(os.path.exists(output_path))
+
+    def test_filter_sample_retention_estimate_subsampled(self):
+        params = {'min_quality': 20, 'quality_window': 1,
+                  'min_length_fraction': 0.5, 'max_ambiguous': 0,
+                  'compression_level': 9, 'min_retention': 0.5,
+                  'retention_sample_size': 1, 'subsample_fraction': 0.01,
+                  'subsample_seed': 0}
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_path = os.path.join(temp_dir, 'in.fastq.gz')
+            output_path = os.path.join(temp_dir, 'out.fastq.gz')
+            with gzip.open(input_path, 'wb') as fh:
+                fh.write(b'@b\nACGTACGT\n+\nII######\n' * 5)
+
+            # the reads not drawn do not count towards the sample from which
+            # the retention is estimated, and none were drawn
+            counts, = _filter_sample_multi(
+                input_path, [output_path], 33, [params])
+            self.assertEqual(counts['processing'], 'full')
+            self.assertEqual(counts['reads-not-subsampled'], 5)
+
+    def test_filter_sample_read_cap(self):
+        params = {'min_quality': 20, 'quality_window': 1,
+                  'min_length_fraction': 0.5, 'max_ambiguous': 0,
+                  'compression_level': 9, 'max_reads_per_sample': 25001}
+        reads = b''.join(b'@r%d\nACGTACGT\n+\nIIIIIIII\n'
+                         b'@x%d\nACGTACGT\n+\nII######\n' % (i, i)
+                         for i in range(100000))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_path = os.path.join(temp_dir, 'in.fastq.gz')
+            output_path = os.path.join(temp_dir, 'out.fastq.gz')
+            with gzip.open(input_path, 'wb') as fh:
+                fh.write(reads)
+
+            counts, = _filter_sample_multi(
+                input_path, [output_path], 33, [params])
+            self.assertEqual(counts['processing'], 'capped')
+            self.assertEqual(counts['total-retained-reads'], 25001)
+            # filtering ended at the last read retained, and the reads
+            # following it are not counted
+            self.assertEqual(counts['reads-too-short-after-truncation'],
+                             25000)
+            self.assertEqual(counts['total-input-reads'], 50001)
+            obs = gzip.open(output_path, 'rb').read().split(b'\n')[::4]
+            self.assertEqual(obs[:2], [b'@r0', b'@r1'])
+            self.assertEqual(obs[-2:], [b'@r25000', b''])
+
+    def test_filter_sample_subsample(self):
+        params = {'min_quality': 20, 'quality_window': 1,
+                  'min_length_fraction': 0.5, 'max_ambiguous': 0,
+                  'compression_level': 9, 'subsample_fraction': 0.25,
+                  'subsample_seed': 7}
+        reads = b''.join(b'@r%d\nACGTACGT\n+\nIIIIIIII\n'
+                         b'@x%d\nACGTACGT\n+\nII######\n' % (i, i)
+                         for i in range(20000))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_path = os.path.join(temp_dir, 'in.fastq.gz')
+            with gzip.open(input_path, 'wb') as fh:
+                fh.write(reads)
+
+            outputs = []
+            for i in range(2):
+                output_path = os.path.join(temp_dir, 'out%d.fastq.gz' % i)
+                counts, = _filter_sample_multi(
+                    input_path, [output_path], 33, [params])
+                outputs.append(gzip.open(output_path, 'rb').read())
+
+                self.assertEqual(counts['total-input-reads'], 40000)
+                # every read drawn is either retained or filtered out
+                self.assertEqual(
+                    counts['reads-not-subsampled'] +
+                    counts['total-retained-reads'] +
+                    counts['reads-too-short-after-truncation'], 40000)
+                self.assertAlmostEqual(counts['reads-not-subsampled'],
+                                       30000, delta=500)
+                self.assertNotIn('processing', counts)
+            # a seed draws the same reads every time
+            self.assertEqual(outputs[0], outputs[1])
+            self.assertEqual(
+                outputs[0].count(b'@r'), counts['total-retained-reads'])
+
+    def test_filter_samples_subsample_none_drawn(self):
+        params = {'min_quality': 20, 'quality_window': 1,
+                  'min_length_fraction': 0.5, 'max_ambiguous': 0,
+                  'compression_level': 9, 'subsample_fraction': 0.01,
+                  'subsample_seed': 0}
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_path = os.path.join(temp_dir, 'in.fastq.gz')
+            with gzip.open(input_path, 'wb') as fh:
+                fh.write(b''.join(b'@r%d\nACGTACGT\n+\nIIIIIIII\n' % i
+                                  for i in range(5)))
+
+            counts, = _filter_samples(
+                [(input_path, os.path.join(temp_dir, 'out.fastq.gz'))],
+                33, params, n_jobs=1)
+            self.assertEqual(counts['total-input-reads'], 5)
+            self.assertEqual(counts['reads-not-subsampled'], 5)
+            self.assertEqual(counts['total-retained-reads'], 0)
+
+    def test_gzip_backend(self):
+        # the standard library is used when python-isal is not installed
+        with mock.patch.dict(sys.modules, {'isal': None}):
+            self.assertEqual(_load_backend().name, 'gzip')
+
+        # and filters samples as python-isal does
+        backend = _gzip_backend()
+
+        params = {'min_quality': 33, 'quality_window': 1,
+                  'min_length_fraction': 0.25, 'max_ambiguous': 0,
+                  'compression_level': 9}
+        input_path = self.get_data_path('simple.fastq.gz')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            outputs = []
+            for i, patched in enumerate([False, True]):
+                output_path = os.path.join(temp_dir, '%d.fastq.gz' % i)
+                with contextlib.ExitStack() as stack:
+                    if patched:
+                        for module in ('_compression', '_filter'):
+                            stack.enter_context(mock.patch(
+                                'q2_quality_filter.%s._BACKEND' % module,
+                                backend))
+                    counts = _filter_sample(input_path, output_path, 33,
+                                            params)
+                outputs.append((counts,
+                                gzip.open(output_path, 'rb').read()))
+            self.assertEqual(outputs[1], outputs[0])
+
+    def test_parallel_gzip_writer(self):
+        lines = [b'@read%d\nACGT\n+\nIIII\n' % i for i in range(1000)]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'out.fastq.gz')
+            with _ParallelGzipWriter(path, threads=3, member_size=100) as fh:
+                for line in lines:
+                    fh.write(line)
+
+            self.assertEqual(gzip.open(path, 'rb').read(), b''.join(lines))
+            with open(path, 'rb') as fh:
+                # one gzip member was written per block of data
+                self.assertGreater(fh.read().count(b'\x1f\x8b\x08'), 100)
+            FastqGzFormat(path, mode='r').validate()
+
+    def test_sample_writer_copy_through(self):
+        params = {'min_quality': 20, 'quality_window': 1,
+                  'min_length_fraction': 0.25, 'max_ambiguous': 0,
+                  'compression_level': 9}
+        clean = b''.join(b'@r%d\nACGTACGT\n+\nIIIIIIII\n' % i
+                         for i in range(10))
+        dirty = b'@x\nACGTACGT\n+\nIIIIII##\n'
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for data, exp, linked in [
+                    (clean, clean, True),
+                    # the unmodified reads preceding a truncated read are
+                    # copied from the input
+                    (clean + dirty,
+                     clean + b'@x\nACGTAC\n+\nIIIIII\n', False),
+                    # bytes.strip() semantics are retained
+                    (clean.replace(b'\n', b'\r\n'), clean, False),
+                    (clean[:-1], clean, False)]:
+                input_path = os.path.join(temp_dir, 'in.fastq.gz')
+                output_path = os.path.join(temp_dir, 'out.fastq.gz')
+                with gzip.open(input_path, 'wb') as fh:
+                    fh.write(data)
+
+                writer = _SampleWriter(output_path, params,
+                                       input_path=input_path)
+                with gzip.open(input_path, 'rb') as fh:
+                    # small blocks spread the reads over many batches
+                    _filter_batches(_iter_fastq_batches(fh, 33, 50), writer,
+                                    params)
+                    writer.close(input_size=fh.tell())
+
+                self.assertEqual(gzip.open(output_path, 'rb').read(), exp)
+                with open(input_path, 'rb') as a, \
+                        open(output_path, 'rb') as b:
+                    self.assertEqual(a.read() == b.read(), linked)
+                os.remove(output_path)
+
     def test_runs_of_ones(self):
         data = [np.array([0, 0, 0, 0, 0, 0], dtype=bool),
                 np.array([1, 0, 1, 0, 1, 0], dtype=bool),
@@ -61,6 +482,427 @@ class FilterTests(TestPluginBase):
             npt.assert_equal(o_starts, exp_starts[i])
             npt.assert_equal(o_lengths, exp_lengths[i])
 
+    def test_first_bad_window(self):
+        qual = np.array([[40, 40, 40, 40, 40, 40],
+                         [2, 40, 2, 40, 2, 40],
+                         [2, 2, 2, 2, 2, 2],
+                         [40, 2, 2, 2, 40, 0],
+                         [40, 2, 40, 2, 2, 0]])
+        mask = np.ones(qual.shape, dtype=bool)
+        mask[3:, 5] = False
+
+        npt.assert_equal(_first_bad_window(qual, mask, 20, 0),
+                         np.array([-1, 0, 0, 1, 1]))
+        npt.assert_equal(_first_bad_window(qual, mask, 20, 1),
+                         np.array([-1, -1, 0, 1, 3]))
+        # padding beyond the end of a read is never a low score
+        npt.assert_equal(_first_bad_window(qual, mask, 20, 2),
+                         np.array([-1, -1, 0, 1, -1]))
+        npt.assert_equal(_first_bad_window(qual, mask, 20, 6),
+                         np.array([-1, -1, -1, -1, -1]))
+
+    def test_first_bad_mean(self):
+        qual = np.array([[40, 40, 40, 40, 40, 40],
+                         [2, 40, 2, 40, 2, 40],
+                         [2, 2, 2, 2, 2, 2],
+                         [40, 2, 2, 2, 40, 0],
+                         [40, 2, 40, 2, 2, 0]], dtype=np.uint8)
+        mask = np.ones(qual.shape, dtype=bool)
+        mask[3:, 5] = False
+
+        npt.assert_equal(_first_bad_mean(qual, mask, 20, 2),
+                         np.array([-1, -1, 0, 1, 3]))
+        npt.assert_equal(_first_bad_mean(qual, mask, 20, 3),
+                         np.array([-1, 0, 0, 0, 1]))
+        # only windows lying wholly within a read are considered
+        npt.assert_equal(_first_bad_mean(qual, mask, 20, 6),
+                         np.array([-1, -1, 0, -1, -1]))
+        npt.assert_equal(_first_bad_mean(qual, mask, 20, 7),
+                         np.array([-1, -1, -1, -1, -1]))
+
+    def test_mott_position(self):
+        qual = np.array([[40, 40, 40, 40, 0],
+                         [40, 40, 10, 10, 0],
+                         [40, 10, 40, 10, 10],
+                         [10, 10, 10, 0, 0],
+                         [10, 40, 40, 40, 10]], dtype=np.uint8)
+        mask = np.array([[1, 1, 1, 1, 0],
+                         [1, 1, 1, 1, 0],
+                         [1, 1, 1, 1, 1],
+                         [1, 1, 1, 0, 0],
+                         [1, 1, 1, 1, 1]], dtype=bool)
+        # the scan from the 3' end stops once the sum is negative, so the
+        # low score at the start of the last read is kept
+        npt.assert_equal(_mott_position(qual, mask, 20, 3),
+                         np.array([-1, 2, 3, 0, 4]))
+
+    def test_poly_g_start(self):
+        data = (b'@a\nACGTGGGGGG\n+\nIIIIIIIIII\n'
+                b'@b\nACGTGGAGGG\n+\nIIIIIIIIII\n'
+                b'@c\nACGTGGAGAG\n+\nIIIIIIIIII\n'
+                b'@d\nACGTACGTAC\n+\nIIIIIIIIII\n'
+                b'@e\nGGG\n+\nIII\n')
+        batch, = _iter_fastq_batches(io.BytesIO(data), 33)
+        npt.assert_equal(_poly_g_start(batch.seq, batch.seq_mask, 3, 0),
+                         np.array([4, 7, -1, -1, 0]))
+        npt.assert_equal(_poly_g_start(batch.seq, batch.seq_mask, 3, 1),
+                         np.array([2, 4, 7, -1, 0]))
+        npt.assert_equal(_poly_g_start(batch.seq, batch.seq_mask, 4, 1),
+                         np.array([2, 4, -1, -1, -1]))
+
+    def test_filter_batch_poly_g(self):
+        data = (b'@a\nACGTACGGGGGG\n+\nIIIIIIIIIIII\n'
+                b'@b\nACGTACGGGGGG\n+\nIIII########\n'
+                b'@c\nACGGGGGGGGGG\n+\nIIIIIIIIIIII\n')
+        batch, = _iter_fastq_batches(io.BytesIO(data), 33)
+        obs = _filter_batch(batch, min_quality=20, quality_window=1,
+                            min_length_fraction=0.3, max_ambiguous=0,
+                            poly_g_min_length=5)
+        npt.assert_equal(obs.lengths, np.array([6, 4, 2]))
+        # a tail removed by truncation is not trimmed again
+        npt.assert_equal(obs.poly_g, np.array([True, False, True]))
+        npt.assert_equal(obs.kept, np.array([True, True, False]))
+        self.assertEqual(b''.join(_format_records(batch, obs)),
+                         b'@a\nACGTAC\n+\nIIIIII\n'
+                         b'@b\nACGT\n+\nIIII\n')
+
+        # a tail left at the 3' end by truncation is trimmed as well
+        seq = b'ACGT' * 10 + b'G' * 15 + b'ACTACTACTA'
+        data = b'@d\n%s\n+\n%s\n' % (seq, b'I' * 55 + b'#' * 10)
+        batch, = _iter_fastq_batches(io.BytesIO(data), 33)
+        obs = _filter_batch(batch, min_quality=20, quality_window=1,
+                            min_length_fraction=0.3, max_ambiguous=0,
+                            poly_g_min_length=10, poly_g_max_mismatches=0)
+        npt.assert_equal(obs.truncated, np.array([True]))
+        npt.assert_equal(obs.poly_g, np.array([True]))
+        npt.assert_equal(obs.lengths, np.array([40]))
+
+    def test_filter_batch_sliding_window(self):
+        data = (b'@a\nACGTACGT\n+\nIIIIIIII\n'
+                b'@b\nACGTACGT\n+\nIIII5#5#\n'
+                b'@c\nACGTACGT\n+\nI#I#I#I#\n')
+        batch, = _iter_fastq_batches(io.BytesIO(data), 33)
+        obs = _filter_batch(batch, min_quality=20, quality_window=2,
+                            min_length_fraction=0.25, max_ambiguous=0,
+                            trim_mode='sliding-window')
+        npt.assert_equal(obs.lengths, np.array([8, 4, 8]))
+        npt.assert_equal(obs.kept, np.array([True, True, True]))
+
+    def test_expected_errors(self):
+        qual = np.array([[10, 20, 30, 40],
+                         [10, 10, 10, 0]], dtype=np.uint8)
+        npt.assert_allclose(_expected_errors(qual, np.array([4, 3])),
+                            [0.1111, 0.3])
+        npt.assert_allclose(_expected_errors(qual, np.array([1, 0])),
+                            [0.1, 0.0])
+
+    def test_filter_batch_expected_errors(self):
+        data = (b'@a\nACGTACGT\n+\nIIIIIIII\n'
+                b'@b\nACGTACGT\n+\nIIIIII++\n'
+                b'@c\nACNTACGT\n+\n++++++++\n'
+                b'@d\nACGT\n+\n+++5\n')
+        batch, = _iter_fastq_batches(io.BytesIO(data), 33)
+        obs = _filter_batch(batch, min_quality=2, quality_window=3,
+                            min_length_fraction=0.5, max_ambiguous=0,
+                            max_expected_errors=0.25)
+        npt.assert_equal(obs.too_many_errors,
+                         np.array([False, False, False, True]))
+        npt.assert_equal(obs.ambiguous, np.array([False, False, True, False]))
+        npt.assert_equal(obs.kept, np.array([True, True, False, False]))
+
+        obs = _filter_batch(batch, min_quality=2, quality_window=3,
+                            min_length_fraction=0.5, max_ambiguous=0,
+                            max_expected_errors_per_base=0.02)
+        npt.assert_equal(obs.too_many_errors,
+                         np.array([False, True, False, True]))
+
+    def test_filter_batch(self):
+        data = (b'@a\nACGTACGT\n+\nIIIIIIII\n'
+                b'@b\nACGTACGT\n+\nIIIIII##\n'
+                b'@c\nACGTACGT\n+\nII######\n'
+                b'@d\nACNTACGT\n+\nIIIII###\n')
+        batch, = _iter_fastq_batches(io.BytesIO(data), 33)
+        obs = _filter_batch(batch, min_quality=20, quality_window=1,
+                            min_length_fraction=0.5, max_ambiguous=0)
+
+        npt.assert_equal(obs.lengths, np.array([8, 6, 2, 5]))
+        npt.assert_equal(obs.truncated, np.array([False, True, True, True]))
+        npt.assert_equal(obs.too_short, np.array([False, False, True,
+                                                  False]))
+        npt.assert_equal(obs.ambiguous, np.array([False, False, False,
+                                                  True]))
+        npt.assert_equal(obs.kept, np.array([True, True, False, False]))
+        self.assertEqual(b''.join(_format_records(batch, obs)),
+                         b'@a\nACGTACGT\n+\nIIIIIIII\n'
+                         b'@b\nACGTAC\n+\nIIIIII\n')
+
+        # a batch of empty reads, as adapter trimming may leave, is kept
+        batch, = _iter_fastq_batches(io.BytesIO(b'@a\n\n+\n\n@b\n\n+\n\n'),
+                                     33)
+        for trim_mode in ['consecutive', 'sliding-window', 'mott']:
+            obs = _filter_batch(batch, min_quality=20, quality_window=1,
+                                min_length_fraction=0.5, max_ambiguous=0,
+                                trim_mode=trim_mode, poly_g_min_length=5)
+            npt.assert_equal(obs.lengths, np.array([0, 0]))
+            npt.assert_equal(obs.kept, np.array([True, True]))
+            self.assertEqual(b''.join(_format_records(batch, obs)),
+                             b'@a\n\n+\n\n@b\n\n+\n\n')
+
+    def test_count_ambiguous_spans(self):
+        data = (b'@a\nNCGTACGN\n+\nIIIIIIII\n'
+                b'@b\r\nACNN\r\n+\r\nIIII\r\n'
+                b'@c\n\n+\n\n'
+                b'@d\nNNNN\n+\nIIII\n')
+        batch, = _iter_fastq_batches(io.BytesIO(data), 33)
+        for lengths in ([8, 4, 0, 4], [7, 3, 0, 1], [0, 2, 0, 0]):
+            lengths = np.array(lengths)
+            npt.assert_equal(_count_ambiguous_spans(batch, lengths),
+                             _count_ambiguous(batch, lengths))
+        npt.assert_equal(_count_ambiguous_spans(batch[[1, 3]],
+                                                np.array([4, 2])),
+                         np.array([2, 2]))
+
+    def test_filter_plan(self):
+        params = {'min_quality': 20, 'quality_window': 1,
+                  'min_length_fraction': 0.5, 'max_ambiguous': 0,
+                  'max_expected_errors': 0.01}
+        data = (b'@a\nACGTACGT\n+\nIIIIIIII\n'
+                b'@b\nACGTACGT\n+\nIIIIII##\n'
+                b'@c\nACGTACGT\n+\nII######\n'
+                b'@d\nACNTACGT\n+\nIIIII###\n'
+                b'@e\nACGTACGT\n+\n5555555#\n')
+        plan = _FilterPlan(params)
+        for batch in _iter_fastq_batches(io.BytesIO(data * 3), 33, 100):
+            obs = plan.filter(batch)
+            exp = _filter_batch(batch, 20, 1, 0.5, 0,
+                                max_expected_errors=0.01)
+            for field in obs._fields:
+                npt.assert_equal(getattr(obs, field), getattr(exp, field))
+        # both counters were timed on the first batch, and one was chosen
+        self.assertEqual(set(plan.times),
+                         {'_count_ambiguous', '_count_ambiguous_spans'})
+        self.assertIn(plan.count_ambiguous,
+                      (_count_ambiguous, _count_ambiguous_spans))
+
+    def test_truncation_index(self):
+        params = {'min_quality': 33, 'quality_window': 1,
+                  'min_length_fraction': 0.25, 'max_ambiguous': 0,
+                  'compression_level': 9}
+        input_path = self.get_data_path('simple.fastq.gz')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            exp_path = os.path.join(temp_dir, 'exp.fastq.gz')
+            obs_path = os.path.join(temp_dir, 'obs.fastq.gz')
+            index_dir = os.path.join(temp_dir, 'index')
+            for fraction in [0.25, 0.75]:
+                params['min_length_fraction'] = fraction
+                exp = _filter_sample(input_path, exp_path, 33, params)
+                obs = _filter_sample(input_path, obs_path, 33,
+                                     dict(params,
+                                          truncation_index=index_dir))
+                self.assertEqual(obs, exp)
+                self.assertEqual(gzip.open(obs_path, 'rb').read(),
+                                 gzip.open(exp_path, 'rb').read())
+                os.remove(exp_path)
+                os.remove(obs_path)
+            self.assertEqual(len(os.listdir(index_dir)), 1)
+
+            index = _TruncationIndex(index_dir, input_path, 33, 33, 1)
+            self.assertTrue(index.found)
+            batch, = _read_fastq_batches(input_path, 33)
+            exp = _measure_batch(batch, 33, 1)
+            obs = index.take(len(batch))
+            for o, e in zip(obs, exp):
+                npt.assert_equal(o, e)
+            index.finish()
+
+            with self.assertRaisesRegex(ValueError, 'fewer reads'):
+                index.take(1)
+
+    def test_result_cache(self):
+        params = {'min_quality': 33, 'quality_window': 1,
+                  'min_length_fraction': 0.25, 'max_ambiguous': 0,
+                  'compression_level': 9}
+        input_path = self.get_data_path('simple.fastq.gz')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = _ResultCache(os.path.join(temp_dir, 'cache'))
+            key = _sample_key(input_path, 33, params)
+            self.assertNotEqual(
+                key, _sample_key(input_path, 33, dict(params,
+                                                      max_ambiguous=1)))
+            self.assertEqual(key, _sample_key(input_path, 33, dict(
+                params, truncation_index='foo')))
+
+            exp_path = os.path.join(temp_dir, 'exp.fastq.gz')
+            self.assertIsNone(cache.get(key, exp_path))
+            exp = _filter_sample(input_path, exp_path, 33, params)
+            cache.put(key, exp_path, exp)
+            cache.put('other', os.path.join(temp_dir, 'missing'), exp)
+            os.utime(os.path.join(cache.directory, key), (0, 0))
+            os.utime(os.path.join(cache.directory, 'other'), (1, 1))
+
+            # using an entry makes it the most recently used
+            obs_path = os.path.join(temp_dir, 'obs.fastq.gz')
+            self.assertEqual(cache.get(key, obs_path), exp)
+            self.assertEqual(gzip.open(obs_path, 'rb').read(),
+                             gzip.open(exp_path, 'rb').read())
+            self.assertEqual([entry[0] for entry in cache.entries()],
+                             ['other', key])
+
+            # the least recently used entry is evicted first
+            self.assertEqual(cache.prune(os.path.getsize(exp_path) + 200),
+                             ['other'])
+            self.assertEqual(cache.prune(0), [key])
+            self.assertEqual(cache.entries(), [])
+
+    def test_cache_main(self):
+        params = {'min_quality': 33, 'quality_window': 1,
+                  'min_length_fraction': 0.25, 'max_ambiguous': 0,
+                  'compression_level': 9}
+        input_path = self.get_data_path('simple.fastq.gz')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # a directory which does not exist is not created
+            missing = os.path.join(temp_dir, 'missing')
+            for argv in (['inspect', missing],
+                         ['prune', missing, '--max-size', '0']):
+                with redirected_stdio(stderr=os.devnull):
+                    with self.assertRaises(SystemExit):
+                        _cache_main(argv)
+            self.assertFalse(os.path.exists(missing))
+
+            cache_dir = os.path.join(temp_dir, 'cache')
+            cache = _ResultCache(cache_dir)
+            output_path = os.path.join(temp_dir, 'out.fastq.gz')
+            with redirected_stdio(stdout=os.devnull):
+                counts = _filter_sample(input_path, output_path, 33, params)
+            cache.put('a', output_path, counts)
+            cache.put('b', os.path.join(temp_dir, 'none'), counts)
+
+            # pruning needs an explicit size
+            with redirected_stdio(stderr=os.devnull):
+                with self.assertRaises(SystemExit):
+                    _cache_main(['prune', cache_dir])
+            self.assertEqual(len(cache.entries()), 2)
+
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout):
+                _cache_main(['inspect', cache_dir])
+            self.assertIn('2 entries', stdout.getvalue())
+
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout):
+                _cache_main(['prune', cache_dir, '--max-size', '0'])
+            self.assertEqual(stdout.getvalue(), 'evicted 2 entries\n')
+            self.assertEqual(cache.entries(), [])
+
+    def test_filter_params(self):
+        self.assertEqual(
+            _filter_params({'min_quality': 20, 'n_jobs': 2}, profile=True),
+            {'min_quality': 20, 'profile': True})
+
+        # every other parameter of an action is passed on to the filter
+        run_options = {'demux', 'n_jobs', 'prefetch', 'cache_dir',
+                       'cache_max_size', 'checkpoint_dir'}
+        for action in (q_score, q_score_with_profile, q_score_stats,
+                       q_score_paired):
+            names = set(inspect.signature(action).parameters) - run_options
+            self.assertLessEqual(names, set(_filter_param_names))
+
+    def test_checkpoint_resume(self):
+        params = {'min_quality': 33, 'quality_window': 1,
+                  'min_length_fraction': 0.25, 'max_ambiguous': 0,
+                  'compression_level': 9}
+        data = gzip.open(self.get_data_path('simple.fastq.gz'), 'rb').read()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            samples = []
+            for i in range(3):
+                input_path = os.path.join(temp_dir, '%d.fastq.gz' % i)
+                with gzip.open(input_path, 'wb') as fh:
+                    fh.write(data * (i + 1))
+                samples.append((input_path,
+                                os.path.join(temp_dir, '%d.out' % i)))
+            exp = _filter_samples(samples, 33, params, n_jobs=1)
+            exp_reads = [gzip.open(path, 'rb').read() for _, path in samples]
+
+            # the run is interrupted by the last sample
+            checkpoint_dir = os.path.join(temp_dir, 'checkpoint')
+            with open(samples[2][0], 'rb') as fh:
+                last = fh.read()
+            with open(samples[2][0], 'wb') as fh:
+                fh.write(last[:-20])
+            for _, path in samples:
+                os.remove(path)
+            with self.assertRaises(EOFError):
+                _filter_samples_stored(samples, 33, params, 1, 0,
+                                       [_Checkpoint(checkpoint_dir)])
+            # a partially written journal line is ignored
+            with open(os.path.join(checkpoint_dir, 'journal.jsonl'),
+                      'a') as fh:
+                fh.write('{"key": ')
+
+            with open(samples[2][0], 'wb') as fh:
+                fh.write(last)
+            for _, path in samples:
+                if os.path.exists(path):
+                    os.remove(path)
+            checkpoint = _Checkpoint(checkpoint_dir)
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout):
+                obs = _filter_samples_stored(samples, 33, params, 1, 0,
+                                             [checkpoint])
+            self.assertIn('2 of 3 samples', stdout.getvalue())
+            self.assertEqual(obs, exp)
+            self.assertEqual([gzip.open(path, 'rb').read()
+                              for _, path in samples], exp_reads)
+
+            checkpoint.finish()
+            self.assertFalse(os.path.exists(checkpoint_dir))
+
+            # the other files of a directory are left in place
+            with open(os.path.join(temp_dir, 'notes.txt'), 'w') as fh:
+                fh.write('unrelated')
+            before = sorted(os.listdir(temp_dir))
+            checkpoint = _Checkpoint(temp_dir)
+            checkpoint.put('key', samples[0][1], exp[0])
+            checkpoint.finish()
+            self.assertEqual(sorted(os.listdir(temp_dir)), before)
+
+    def test_sweep_batch(self):
+        batch, = _read_fastq_batches(self.get_data_path('simple.fastq.gz'),
+                                     33)
+        grid = ([20, 33, 40], [0, 1, 3], [0.25, 0.5], [0, 1])
+        obs = _sweep_batch(batch, *grid)
+        self.assertEqual(obs.shape, (36, 4))
+
+        for counts, params in zip(obs, itertools.product(*grid)):
+            exp = _filter_batch(batch, *params)
+            npt.assert_equal(counts, [exp.truncated.sum(),
+                                      exp.too_short.sum(),
+                                      exp.ambiguous.sum(), exp.kept.sum()])
+
+    def test_format_records_zero_copy(self):
+        data = (b'@a\nACGT\n+\nIIII\n'
+                b'@b\nACGT\n+\nIIII\n'
+                b'@c\nACGT\n+\nII##\n'
+                b'@d\r\nACGT\r\n+\r\nIIII\r\n'
+                b'@e\nACGT\n+\nIIII\n'
+                b'@f\nACGT\n+\nIIII\n'
+                b'@g\nACGT\n+\nIIII\n')
+        batch, = _iter_fastq_batches(io.BytesIO(data), 33)
+        obs = _filter_batch(batch, min_quality=20, quality_window=1,
+                            min_length_fraction=0.25, max_ambiguous=0)
+        obs.kept[5] = False
+
+        pieces = _format_records(batch, obs)
+        # a and b are adjacent and unmodified, c is truncated, d is not
+        # stored verbatim and f separates e and g
+        self.assertEqual([bytes(piece) for piece in pieces],
+                         [b'@a\nACGT\n+\nIIII\n@b\nACGT\n+\nIIII\n',
+                          b'@c\nAC\n+\nII\n',
+                          b'@d\nACGT\n+\nIIII\n',
+                          b'@e\nACGT\n+\nIIII\n',
+                          b'@g\nACGT\n+\nIIII\n'])
+        self.assertIsInstance(pieces[0], memoryview)
+
     def test_truncate(self):
         data = [('@x', 'ATGCG', '+', 'IIIIA', np.array([40, 40, 40, 40, 32])),
                 ('@y', 'TGCAC', '+', 'ABCDA', np.array([32, 33, 34, 35, 32]))]
@@ -86,6 +928,23 @@ class FilterTests(TestPluginBase):
             with redirected_stdio(stdout=os.devnull):
                 self.plugin.methods['q_score'](ar, min_quality=50)
 
+    def test_q_score_stats(self):
+        ar = Artifact.load(self.get_data_path('simple.qza'))
+        with redirected_stdio(stdout=os.devnull):
+            _, exp_ar = self.plugin.methods['q_score'](
+                ar, quality_window=1, min_quality=33, min_length_fraction=0.25)
+            obs_ar, = self.plugin.methods['q_score_stats'](
+                ar, quality_window=1, min_quality=33, min_length_fraction=0.25)
+        pdt.assert_frame_equal(obs_ar.view(pd.DataFrame),
+                               exp_ar.view(pd.DataFrame))
+
+        # the stats are reported when every read is filtered out
+        with redirected_stdio(stdout=os.devnull):
+            obs_ar, = self.plugin.methods['q_score_stats'](ar, min_quality=50)
+        obs = obs_ar.view(pd.DataFrame)
+        self.assertEqual(obs['total-retained-reads'].sum(), 0)
+        self.assertGreater(obs['total-input-reads'].sum(), 0)
+
     def test_q_score_numeric_ids(self):
         ar = Artifact.load(self.get_data_path('numeric_ids.qza'))
         exp_sids = {'00123', '0.4560'}
@@ -124,6 +983,7 @@ class FilterTests(TestPluginBase):
                                              ('bar', 1, 0, 0, 0, 1)],
                                             columns=columns)
         exp_drop_ambig_stats = exp_drop_ambig_stats.set_index('sample-id')
+        exp_drop_ambig_stats['compression-backend'] = _BACKEND.name
         obs = []
         iterator = obs_drop_ambig.sequences.iter_views(FastqGzFormat)
         for sample_id, fp in iterator:
@@ -149,6 +1009,7 @@ class FilterTests(TestPluginBase):
                                         ('bar', 1, 1, 1, 0, 0)],
                                        columns=columns)
         exp_trunc_stats = exp_trunc_stats.set_index('sample-id')
+        exp_trunc_stats['compression-backend'] = _BACKEND.name
 
         obs = []
         for sample_id, fp in obs_trunc.sequences.iter_views(FastqGzFormat):
@@ -156,6 +1017,244 @@ class FilterTests(TestPluginBase):
         self.assertEqual(sorted(obs), sorted(exp_trunc))
         pdt.assert_frame_equal(stats, exp_trunc_stats.loc[stats.index])
 
+    def _assert_q_score_unchanged(self, **kwargs):
+        # the output of q_score with kwargs matches that of the defaults
+        ar = Artifact.load(self.get_data_path('simple.qza'))
+        with redirected_stdio(stdout=os.devnull):
+            exp_ar, exp_stats_ar = self.plugin.methods['q_score'](
+                ar, quality_window=1, min_quality=33, min_length_fraction=0.25)
+            obs_ar, obs_stats_ar = self.plugin.methods['q_score'](
+                ar, quality_window=1, min_quality=33, min_length_fraction=0.25,
+                **kwargs)
+
+        exp = exp_ar.view(SingleLanePerSampleSingleEndFastqDirFmt)
+        obs = obs_ar.view(SingleLanePerSampleSingleEndFastqDirFmt)
+        exp_seqs = [(str(sample_id), gzip.open(str(fp), 'rb').read())
+                    for sample_id, fp in exp.sequences.iter_views(
+                        FastqGzFormat)]
+        obs_seqs = [(str(sample_id), gzip.open(str(fp), 'rb').read())
+                    for sample_id, fp in obs.sequences.iter_views(
+                        FastqGzFormat)]
+        self.assertEqual(obs_seqs, exp_seqs)
+        pdt.assert_frame_equal(obs_stats_ar.view(pd.DataFrame),
+                               exp_stats_ar.view(pd.DataFrame))
+
+    def test_q_score_n_jobs(self):
+        self._assert_q_score_unchanged(n_jobs=2)
+
+    def test_q_score_prefetch(self):
+        self._assert_q_score_unchanged(prefetch=2)
+
+    def test_filter_prefetched(self):
+        params = {'min_quality': 33, 'quality_window': 1,
+                  'min_length_fraction': 0.25, 'max_ambiguous': 0,
+                  'compression_level': 9}
+        with tempfile.TemporaryDirectory() as temp_dir:
+            samples = []
+            for name in [b'a', b'b', b'c']:
+                input_path = os.path.join(temp_dir, '%s.fastq.gz' % len(
+                    samples))
+                with gzip.open(input_path, 'wb') as fh:
+                    fh.write(b'@%s\nACGT\n+\nIIII\n' % name)
+                samples.append((input_path, input_path + '.out'))
+
+            obs = _filter_prefetched(samples, 33, params, prefetch=1)
+            self.assertEqual(
+                [counts['total-retained-reads'] for counts in obs], [1, 1, 1])
+            for input_path, output_path in samples:
+                self.assertEqual(gzip.open(output_path, 'rb').read(),
+                                 gzip.open(input_path, 'rb').read())
+
+    def test_iter_paired_batches(self):
+        forward = b''.join(b'@r%d/1\nACGT\n+\nIIII\n' % i for i in range(20))
+        reverse = forward.replace(b'/1', b'/2')
+        # blocks of different sizes split the files differently
+        pairs = list(_iter_paired_batches(
+            _iter_fastq_batches(io.BytesIO(forward), 33, 50),
+            _iter_fastq_batches(io.BytesIO(reverse), 33, 120)))
+        self.assertGreater(len(pairs), 2)
+        names = [(f.line(i, 0), r.line(i, 0))
+                 for f, r in pairs for i in range(len(f))]
+        self.assertEqual(names, [(b'@r%d/1' % i, b'@r%d/2' % i)
+                                 for i in range(20)])
+
+        with self.assertRaisesRegex(ValueError, 'different numbers'):
+            list(_iter_paired_batches(
+                _iter_fastq_batches(io.BytesIO(forward), 33, 50),
+                _iter_fastq_batches(io.BytesIO(reverse[:-40]), 33, 50)))
+
+    def test_read_paired_demux(self):
+        files = [('a', 'a_R1', 'forward'), ('b', 'b_R1', 'forward'),
+                 ('a', 'a_R2', 'reverse'), ('b', 'b_R2', 'reverse')]
+        with mock.patch('q2_quality_filter._paired._read_demux',
+                        return_value=(33, files)):
+            self.assertEqual(_read_paired_demux(None),
+                             (33, [('a', 'a_R1', 'a_R2'),
+                                   ('b', 'b_R1', 'b_R2')]))
+        with mock.patch('q2_quality_filter._paired._read_demux',
+                        return_value=(33, files[:3])):
+            with self.assertRaisesRegex(ValueError,
+                                        'reverse reads of sample b'):
+                _read_paired_demux(None)
+
+    def test_filter_paired_sample(self):
+        params = {'min_quality': 20, 'quality_window': 1,
+                  'min_length_fraction': 0.5, 'max_ambiguous': 0,
+                  'compression_level': 9}
+        forward = [b'@r%d/1\nACGTACGT\n+\nIIIIIIII\n' % i for i in range(6)]
+        reverse = [b'@r%d/2\nACGTACGT\n+\nIIIIIIII\n' % i for i in range(6)]
+        # truncated to 6 bases in the forward read only
+        forward[1] = b'@r1/1\nACGTACGT\n+\nIIIIII##\n'
+        # too short in the forward read, ambiguous in the reverse read
+        forward[2] = b'@r2/1\nACGTACGT\n+\nII######\n'
+        reverse[2] = b'@r2/2\nACNTACGT\n+\nIIIIIIII\n'
+        # ambiguous in the reverse read only
+        reverse[4] = b'@r4/2\nACGTACGN\n+\nIIIIIIII\n'
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_paths = []
+            for direction, reads in [('f', forward), ('r', reverse)]:
+                input_paths.append(os.path.join(temp_dir, direction + '.gz'))
+                with gzip.open(input_paths[-1], 'wb') as fh:
+                    fh.write(b''.join(reads))
+            output_paths = [path + '.out' for path in input_paths]
+
+            obs = _filter_paired_sample(input_paths, output_paths, 33,
+                                        params)
+            self.assertEqual(obs, {
+                'total-input-reads': 6, 'total-retained-reads': 4,
+                'reads-truncated': 2,
+                'reads-too-short-after-truncation': 1,
+                'reads-exceeding-maximum-ambiguous-bases': 1})
+
+            forward[1] = b'@r1/1\nACGTAC\n+\nIIIIII\n'
+            for output_path, reads in zip(output_paths, [forward, reverse]):
+                self.assertEqual(gzip.open(output_path, 'rb').read(),
+                                 b''.join(reads[i] for i in [0, 1, 3, 5]))
+
+    def test_quality_profile(self):
+        data = (b'@a\nACGTAC\n+\n+5?II5\n'
+                b'@b\nACG\n+\n5?I\n')
+        batch, = _iter_fastq_batches(io.BytesIO(data), 33)
+        result = _filter_batch(batch, min_quality=20, quality_window=0,
+                               min_length_fraction=0.1, max_ambiguous=0)
+        profile = _QualityProfile.from_batch(batch, result)
+
+        # read a is truncated at its first position and is too short
+        npt.assert_equal(result.kept, np.array([False, True]))
+        exp = np.zeros((2, 6, 41), dtype=np.int64)
+        for position, score in enumerate([10, 20, 30, 40, 40, 20]):
+            exp[0, position, score] += 1
+        for position, score in enumerate([20, 30, 40]):
+            exp[0, position, score] += 1
+            exp[1, position, score] += 1
+        npt.assert_equal(profile.counts, exp)
+
+        # sums widen to the larger profile
+        total = sum([_QualityProfile(np.ones((2, 2, 3), dtype=np.int64)),
+                     profile])
+        self.assertEqual(total.counts.shape, (2, 6, 41))
+        npt.assert_equal(total.counts[:, :2, :3], exp[:, :2, :3] + 1)
+
+    def test_q_score_with_profile(self):
+        ar = Artifact.load(self.get_data_path('simple.qza'))
+        with redirected_stdio(stdout=os.devnull):
+            exp_ar, exp_stats_ar = self.plugin.methods['q_score'](
+                ar, quality_window=1, min_quality=33, min_length_fraction=0.25)
+            obs_ar, obs_stats_ar, profile_ar = self.plugin.methods[
+                'q_score_with_profile'](ar, quality_window=1, min_quality=33,
+                                        min_length_fraction=0.25)
+        pdt.assert_frame_equal(obs_stats_ar.view(pd.DataFrame),
+                               exp_stats_ar.view(pd.DataFrame))
+
+        stats = exp_stats_ar.view(pd.DataFrame)
+        profile = profile_ar.view(pd.DataFrame)
+        self.assertEqual(list(profile.index.unique()), list(stats.index))
+        # each read, and each retained read, has a score at its first base
+        scores = profile.drop(columns=['stage', 'position'])
+        first = profile['position'] == 0
+        for stage, column in [('before', 'total-input-reads'),
+                              ('after', 'total-retained-reads')]:
+            npt.assert_equal(
+                scores[first & (profile['stage'] == stage)].sum(axis=1)
+                .to_numpy(), stats[column].to_numpy())
+
+    def test_q_score_with_profile_types(self):
+        # joined reads are profiled as q_score filters them
+        exp = self.plugin.methods['q_score'].signature
+        obs = self.plugin.methods['q_score_with_profile'].signature
+        self.assertEqual(obs.inputs['demux'].qiime_type,
+                         exp.inputs['demux'].qiime_type)
+        self.assertEqual(obs.outputs['filtered_sequences'].qiime_type,
+                         exp.outputs['filtered_sequences'].qiime_type)
+
+    def test_q_score_multi(self):
+        ar = Artifact.load(self.get_data_path('simple.qza'))
+        with redirected_stdio(stdout=os.devnull):
+            obs_seqs, obs_stats = self.plugin.methods['q_score_multi'](
+                ar, min_quality=[20, 33], quality_window=[2, 1],
+                min_length_fraction=[0.25])
+
+        self.assertEqual(list(obs_seqs),
+                         ['q20-w2-f0.25-a0', 'q33-w1-f0.25-a0'])
+        for key, (quality, window) in zip(obs_seqs, [(20, 2), (33, 1)]):
+            with redirected_stdio(stdout=os.devnull):
+                exp_ar, exp_stats_ar = self.plugin.methods['q_score'](
+                    ar, min_quality=quality, quality_window=window,
+                    min_length_fraction=0.25)
+            exp = exp_ar.view(SingleLanePerSampleSingleEndFastqDirFmt)
+            obs = obs_seqs[key].view(SingleLanePerSampleSingleEndFastqDirFmt)
+            self.assertEqual(
+                [gzip.open(str(fp), 'rb').read()
+                 for _, fp in obs.sequences.iter_views(FastqGzFormat)],
+                [gzip.open(str(fp), 'rb').read()
+                 for _, fp in exp.sequences.iter_views(FastqGzFormat)])
+            pdt.assert_frame_equal(obs_stats[key].view(pd.DataFrame),
+                                   exp_stats_ar.view(pd.DataFrame))
+
+    def test_q_score_multi_mismatched_sets(self):
+        ar = Artifact.load(self.get_data_path('simple.qza'))
+        with self.assertRaisesRegex(ValueError, 'quality_window has 2'):
+            self.plugin.methods['q_score_multi'](
+                ar, min_quality=[20, 30, 33], quality_window=[2, 1])
+
+    def test_q_score_max_expected_errors(self):
+        ar = Artifact.load(self.get_data_path('simple.qza'))
+        with redirected_stdio(stdout=os.devnull):
+            _, exp_ar = self.plugin.methods['q_score'](
+                ar, quality_window=1, min_quality=33, min_length_fraction=0.25)
+            _, obs_ar = self.plugin.methods['q_score'](
+                ar, quality_window=1, min_quality=33, min_length_fraction=0.25,
+                max_expected_errors=0.001)
+        exp = exp_ar.view(pd.DataFrame)
+        obs = obs_ar.view(pd.DataFrame)
+
+        self.assertNotIn('reads-exceeding-maximum-expected-errors',
+                         exp.columns)
+        errors = obs.pop('reads-exceeding-maximum-expected-errors')
+        self.assertTrue((errors > 0).any())
+        pdt.assert_series_equal(
+            obs['total-retained-reads'] + errors,
+            exp['total-retained-reads'], check_names=False)
+
+    def test_q_score_sweep(self):
+        ar = Artifact.load(self.get_data_path('simple.qza'))
+        sweep_ar, = self.plugin.methods['q_score_sweep'](
+            ar, min_quality=[20, 33], quality_window=[1, 2],
+            min_length_fraction=[0.25])
+        sweep = sweep_ar.view(pd.DataFrame)
+        self.assertEqual(len(sweep), 4 * len(sweep.index.unique()))
+
+        for (quality, window), obs in sweep.groupby(['min-quality',
+                                                     'quality-window']):
+            with redirected_stdio(stdout=os.devnull):
+                _, exp_ar = self.plugin.methods['q_score'](
+                    ar, min_quality=quality, quality_window=window,
+                    min_length_fraction=0.25)
+            exp = exp_ar.view(pd.DataFrame)
+            pdt.assert_frame_equal(obs[exp.columns[:-1]],
+                                   exp[exp.columns[:-1]])
+
     def test_q_score_real(self):
         ar = Artifact.load(self.get_data_path('real_data.qza'))
         with redirected_stdio(stdout=os.devnull):
@@ -234,6 +1333,7 @@ class FilterTests(TestPluginBase):
         exp_stats = pd.DataFrame([('foo', 10, 6, 10, 4, 0)],
                                  columns=columns)
         exp_stats = exp_stats.set_index('sample-id')
+        exp_stats['compression-backend'] = _BACKEND.name
         obs = []
         iterator = obs_result.sequences.iter_views(FastqGzFormat)
         for sample_id, fp in iterator:
@@ -319,6 +1419,7 @@ class FilterTests(TestPluginBase):
         exp_stats = pd.DataFrame([('foo', 10, 6, 10, 4, 0)],
                                  columns=columns)
         exp_stats = exp_stats.set_index('sample-id')
+        exp_stats['compression-backend'] = _BACKEND.name
         obs = []
         iterator = obs_result.sequences.iter_views(FastqGzFormat)
         for sample_id, fp in iterator:
@@ -327,6 +1428,55 @@ class FilterTests(TestPluginBase):
         pdt.assert_frame_equal(stats, exp_stats.loc[stats.index])
 
 
+class PipelineTests(TestPluginBase):
+    package = 'q2_quality_filter.test'
+
+    def test_read_ahead(self):
+        producer, consumer = _StageTimes('read'), _StageTimes('filter')
+        obs = list(_ReadAhead(range(100), producer, consumer, maxsize=2))
+        self.assertEqual(obs, list(range(100)))
+        self.assertEqual(str(producer)[:5], 'read ')
+
+    def test_read_ahead_error(self):
+        def produce():
+            yield 1
+            raise KeyError('foo')
+
+        items = _ReadAhead(produce(), _StageTimes('read'),
+                           _StageTimes('filter'))
+        self.assertEqual(next(items), 1)
+        with self.assertRaisesRegex(KeyError, 'foo'):
+            next(items)
+
+    def test_write_behind(self):
+        class Target:
+            def __init__(self):
+                self.written = []
+
+            def write(self, item):
+                self.written.append(item)
+
+            def close(self, suffix):
+                return self.written + [suffix]
+
+        writer = _WriteBehind(Target(), _StageTimes('write'),
+                              _StageTimes('filter'), maxsize=1)
+        for i in range(10):
+            writer.write(i)
+        self.assertEqual(writer.close('end'), list(range(10)) + ['end'])
+
+    def test_write_behind_error(self):
+        class Target:
+            def write(self, item):
+                raise ValueError('bad write')
+
+        writer = _WriteBehind(Target(), _StageTimes('write'),
+                              _StageTimes('filter'))
+        writer.write(1)
+        with self.assertRaisesRegex(ValueError, 'bad write'):
+            writer.join()
+
+
 class TransformerTests(TestPluginBase):
     package = 'q2_quality_filter.test'
 
@@ -350,6 +1500,56 @@ class TransformerTests(TestPluginBase):
         self.assertEqual(obs.column_count, 5)
         self.assertEqual(obs.id_header, 'sample-id')
 
+    def test_optional_columns(self):
+        with open(self.get_data_path('stats-1.txt')) as fh:
+            lines = fh.read().splitlines()
+        lines = ['%s,%s' % (line, 'compression-backend' if i == 0 else 'gzip')
+                 for i, line in enumerate(lines)]
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filepath = os.path.join(temp_dir, 'stats.csv')
+            with open(filepath, 'w') as fh:
+                fh.write('\n'.join(lines) + '\n')
+
+            format = QualityFilterStatsFmt(filepath, mode='r')
+            format.validate()
+            transformer = self.get_transformer(QualityFilterStatsFmt,
+                                               pd.DataFrame)
+            obs = transformer(format)
+            self.assertEqual(list(obs['compression-backend'].unique()),
+                             ['gzip'])
+            self.assertEqual(obs.shape, (34, 6))
+
+            with open(filepath, 'w') as fh:
+                fh.write(lines[0] + ',not-a-column\n')
+            with self.assertRaisesRegex(ValidationError, 'QualityFilterStats'):
+                QualityFilterStatsFmt(filepath, mode='r').validate()
+
+    def test_profile_to_dataframe(self):
+        counts = np.arange(2 * 2 * 3 * 4, dtype=np.uint32).reshape(2, 2, 3, 4)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filepath = os.path.join(temp_dir, 'profile.npz')
+            with open(filepath, 'wb') as fh:
+                np.savez_compressed(fh, sample_ids=np.array(['s1', 's2']),
+                                    counts=counts)
+            format = QualityFilterProfileFmt(filepath, mode='r')
+            format.validate()
+            transformer = self.get_transformer(QualityFilterProfileFmt,
+                                               pd.DataFrame)
+            obs = transformer(format)
+
+        self.assertEqual(obs.shape, (12, 6))
+        self.assertEqual(list(obs.index.unique()), ['s1', 's2'])
+        self.assertEqual(list(obs.loc['s2', 'stage']),
+                         ['before'] * 3 + ['after'] * 3)
+        npt.assert_equal(obs.loc['s1', [0, 1, 2, 3]].to_numpy(),
+                         counts[0].reshape(6, 4))
+
+        transformer = self.get_transformer(pd.DataFrame,
+                                           QualityFilterProfileFmt)
+        with np.load(str(transformer(obs))) as data:
+            npt.assert_equal(data['counts'], counts)
+
 
 class TestUsageExamples(TestPluginBase):
     package = 'q2_quality_filter.test'
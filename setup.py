@@ -21,11 +21,18 @@ setup(
     license='BSD-3-Clause',
     entry_points={
         "qiime2.plugins":
-        ["q2-quality-filter=q2_quality_filter.plugin_setup:plugin"]
+        ["q2-quality-filter=q2_quality_filter.plugin_setup:plugin"],
+        "console_scripts":
+        ["q2-quality-filter-cache=q2_quality_filter._cache:main"]
     },
     package_data={
         "q2_quality_filter": ["citations.bib"],
         "q2_quality_filter.test": ["data/*"],
     },
+    # python-isal speeds up reading and writing gzip files, and the
+    # standard library is used without it
+    extras_require={
+        "isal": ["isal"],
+    },
     zip_safe=False,
 )